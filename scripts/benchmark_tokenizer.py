@@ -0,0 +1,91 @@
+import re
+import timeit
+from collections import defaultdict
+from itertools import count
+import lxml.html
+from metarecipe import models
+
+# The tokenizer as it was before words were classified in the same regex pass, kept here as the baseline
+legacy_all_word_re = re.compile(r"(\d+\.\d+|\d+\s*\d?\s*[/⁄]\s*\d+|\d+|[-'a-zA-Z]+|\s*[:°.()&]\s*)")
+legacy_number_re = re.compile(r"(\d+\.\d+|\d+\s*\d?\s*[/⁄]\s*\d+|\d+)")
+legacy_symbol_re = re.compile(r"(\s*[:°.()]\s*)")
+
+
+def legacy_transform_word(word_):
+    if legacy_number_re.match(word_):
+        return "#", word_
+    elif legacy_symbol_re.match(word_):
+        return word_.strip(), word_
+    else:
+        return word_.strip(), None
+
+
+def legacy_document_words(html):
+    results = []
+    document = lxml.html.fromstring(html)
+    document_position = count()
+    element_position = defaultdict(lambda: count())
+    for element in document.iter():
+        text_words = [legacy_transform_word(word) for word in legacy_all_word_re.findall(element.text or '')]
+        tail_words = [legacy_transform_word(word) for word in legacy_all_word_re.findall(element.tail or '')]
+        for (doc_pos, el_pos, (word, original_format)) in zip(document_position, element_position[element],
+                                                               text_words):
+            results.append((word, doc_pos, el_pos, element.tag, original_format))
+        for (doc_pos, el_pos, (word, original_format)) in zip(document_position,
+                                                               element_position[element.getparent()], tail_words):
+            results.append((word, doc_pos, el_pos, element.getparent().tag, original_format))
+    return results
+
+
+def legacy_tokenize(text):
+    return [legacy_transform_word(word) for word in legacy_all_word_re.findall(text)]
+
+
+def pad_page(page, size):
+    """Repeats the body of page until it is at least size bytes long.  Saved recipe pages, with their reviews and
+    related recipes, commonly run to a few hundred KiB, far more than the test fixtures."""
+    start = page.index(">", page.index("<body")) + 1
+    end = page.rindex("</body>")
+    body = page[start:end]
+    copies = max(1, -(-(size - len(page)) // len(body)) + 1)
+    return page[:start] + body * copies + page[end:]
+
+
+def compare(label, legacy_function, current_function, repeat):
+    legacy = min(timeit.repeat(legacy_function, number=1, repeat=repeat))
+    current = min(timeit.repeat(current_function, number=1, repeat=repeat))
+    print("{}: legacy {:.4f}s, current {:.4f}s, speedup {:.2f}x".format(label, legacy, current, legacy / current))
+
+
+def main(html_files, repeat, min_kib):
+    pages = []
+    for html_file in html_files:
+        with open(html_file, encoding="utf-8", errors="replace") as f:
+            page = f.read()
+        pages.append(pad_page(page, min_kib * 1024) if min_kib else page)
+    for page in pages:
+        if legacy_document_words(page) != list(models.RecipeDocument.iter_document_words(page)):
+            raise ValueError("Tokenizer output differs from the legacy tokenizer")
+    # The text the tokenizer sees, without the parsing and position bookkeeping around it
+    texts = [text for page in pages for element in lxml.html.fromstring(page).iter()
+             for text in (element.text, element.tail) if text]
+    for text in texts:
+        if legacy_tokenize(text) != list(models.RecipeDocument.tokenize(text)):
+            raise ValueError("Tokenizer output differs from the legacy tokenizer")
+    total_bytes = sum(len(page.encode("utf-8")) for page in pages)
+    print("{} pages, {:.1f} KiB".format(len(pages), total_bytes / 1024))
+    compare("tokenize only", lambda: [legacy_tokenize(text) for text in texts],
+            lambda: [list(models.RecipeDocument.tokenize(text)) for text in texts], repeat)
+    compare("parse and tokenize", lambda: [legacy_document_words(page) for page in pages],
+            lambda: [list(models.RecipeDocument.iter_document_words(page)) for page in pages], repeat)
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("html_files", nargs="+")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--min-kib", type=int, default=0,
+                        help="Pad each page to at least this size by repeating its body, e.g. 200")
+    args = parser.parse_args()
+    main(args.html_files, args.repeat, args.min_kib)
@@ -0,0 +1,18 @@
+from metarecipe import matching
+from metarecipe.app import app
+
+
+def main(output_dir):
+    with app.test_request_context():
+        index = matching.TrigramIndex.from_database()
+        index.save(output_dir)
+    print("Indexed {} ingredient names into {}".format(len(index), output_dir))
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Writes a TrigramIndex snapshot of ingredient_name, to be loaded "
+                                                 "through the INGREDIENT_INDEX_PATH setting.")
+    parser.add_argument("output_dir")
+    args = parser.parse_args()
+    main(args.output_dir)
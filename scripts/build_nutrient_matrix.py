@@ -0,0 +1,19 @@
+from metarecipe import nutrition
+from metarecipe.app import app
+
+
+def main(output_dir):
+    with app.test_request_context():
+        matrix = nutrition.NutrientMatrix.from_database()
+        matrix.save(output_dir)
+    print("Wrote a {} x {} nutrient matrix to {}".format(len(matrix.ingredient_ids), len(matrix.nutrient_ids),
+                                                         output_dir))
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Writes a NutrientMatrix snapshot of ingredient_nutrient, to be "
+                                                 "memory-mapped through the NUTRIENT_MATRIX_PATH setting.")
+    parser.add_argument("output_dir")
+    args = parser.parse_args()
+    main(args.output_dir)
@@ -0,0 +1,108 @@
+import os
+import pathlib
+from concurrent.futures import ProcessPoolExecutor
+from metarecipe import models, extractors, fetch
+from metarecipe.app import app, db
+
+
+def process_page(url, html):
+    """Cleans and tokenizes a page.  Runs in a worker process, so it only deals in picklable values."""
+    try:
+        title, safe_html, words = extractors.HTMLExtractor.extract(html)
+        return url, title, safe_html, words, None
+    except Exception as e:
+        return url, None, None, None, str(e)
+
+
+def read_checkpoint(checkpoint_file):
+    if not checkpoint_file or not os.path.exists(checkpoint_file):
+        return set()
+    with open(checkpoint_file) as f:
+        return set(line.rstrip("\n") for line in f)
+
+
+def get_present_urls(urls):
+    url_column = models.RecipeDocument.__table__.c.url
+    select = db.select([url_column]).where(url_column.in_(urls))
+    return set(e[0] for e in db.engine.execute(select).fetchall())
+
+
+def load_pages(urls, fetcher, paths):
+    """Returns (url, (raw_html, html)) pairs for the urls that could be read, where raw_html is the bytes of the page
+    as it was saved or served, and (url, error) pairs for those that couldn't."""
+    def read_file(url):
+        with open(paths[url], "rb") as f:
+            raw_html = f.read()
+        return raw_html, raw_html.decode("utf-8", errors="replace")
+
+    def get_page(url):
+        response = fetcher.get(url)
+        if not response.ok:
+            raise extractors.ExtractorException(response)
+        return response.content, response.text
+
+    results = fetcher.map(read_file if paths else get_page, urls)
+    return [(r.url, r.value) for r in results if not r.error], [(r.url, str(r.error)) for r in results if r.error]
+
+
+def main(source, batch_size, processes, checkpoint_file):
+    if os.path.isdir(source):
+        # Saved pages are identified by their file uri
+        paths = {path.resolve().as_uri(): path for path in sorted(pathlib.Path(source).glob("**/*.htm*"))}
+        urls = list(paths)
+    else:
+        paths = None
+        with open(source) as f:
+            urls = [line.strip() for line in f if line.strip()]
+
+    completed = read_checkpoint(checkpoint_file)
+    urls = [url for url in dict.fromkeys(urls) if url not in completed]
+    fetcher = fetch.ConcurrentFetcher()
+    imported = 0
+    failed = 0
+
+    with app.test_request_context(), ProcessPoolExecutor(max_workers=processes) as pool:
+        for batch_start in range(0, len(urls), batch_size):
+            batch = urls[batch_start:batch_start + batch_size]
+            present_urls = get_present_urls(batch)
+            batch = [url for url in batch if url not in present_urls]
+            pages, errors = load_pages(batch, fetcher, paths)
+            page_urls = [url for (url, (raw_html, html)) in pages]
+            page_html = [html for (url, (raw_html, html)) in pages]
+            documents = []
+            pages_by_url = dict(pages)
+            for (url, title, safe_html, words, error) in pool.map(process_page, page_urls, page_html, chunksize=8):
+                if error:
+                    errors.append((url, error))
+                else:
+                    documents.append(models.RecipeDocument(url=url, title=title, raw_html=pages_by_url[url][0],
+                                                           html=safe_html, document_words=words))
+            # One transaction per batch; the words are bulk inserted when the documents are flushed
+            db.session.add_all(documents)
+            db.session.commit()
+            db.session.expunge_all()
+
+            for (url, error) in errors:
+                print("Failed: {} ({})".format(url, error))
+            imported += len(documents)
+            failed += len(errors)
+            # Failed urls are left out of the checkpoint so that they are retried when the import is resumed
+            if checkpoint_file:
+                failed_urls = set(url for (url, error) in errors)
+                with open(checkpoint_file, "a") as f:
+                    f.writelines(url + "\n" for url in urls[batch_start:batch_start + batch_size]
+                                 if url not in failed_urls)
+            print("{}/{} urls processed, {} imported, {} failed".format(min(batch_start + batch_size, len(urls)),
+                                                                       len(urls), imported, failed))
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Imports recipe documents from a file of urls (one per line) or a "
+                                                 "directory of saved html pages.")
+    parser.add_argument("source")
+    parser.add_argument("--batch-size", type=int, default=200)
+    parser.add_argument("--processes", type=int, default=None)
+    parser.add_argument("--checkpoint", default=None, help="File recording processed urls, so the import can resume")
+    args = parser.parse_args()
+    main(args.source, args.batch_size, args.processes, args.checkpoint)
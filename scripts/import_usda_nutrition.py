@@ -1,8 +1,8 @@
+import io
 import os.path
-import re
 import pandas
-from pint import UnitRegistry, UndefinedUnitError
-from metarecipe import models
+from sqlalchemy.dialects import postgresql
+from metarecipe import matching, models, nutrition, units
 from metarecipe.app import app, db
 
 ignored_food_groups = {
@@ -171,116 +171,265 @@ weight_data_columns = ("ndb_id", "sequence", "amount", "measure_description", "g
                        "std_dev")
 
 
-def main(data_dir):
-    ureg = UnitRegistry()
-    food_description_file = os.path.join(data_dir, "FOOD_DES.txt")
-    nutrient_definition_file = os.path.join(data_dir, "NUTR_DEF.txt")
-    nutrition_data_file = os.path.join(data_dir, "NUT_DATA.txt")
-    weight_data_file = os.path.join(data_dir, "WEIGHT.txt")
+def bulk_load(table, frame):
+    """Inserts the rows of a DataFrame whose columns are named after the table's, using COPY on PostgreSQL and a
+    single executemany elsewhere."""
+    if frame.empty:
+        return
+    connection = db.session.connection()
+    if connection.dialect.name == "postgresql":
+        buffer = io.StringIO()
+        frame.to_csv(buffer, index=False, header=False)
+        buffer.seek(0)
+        cursor = connection.connection.cursor()
+        cursor.copy_expert("COPY {} ({}) FROM STDIN WITH CSV".format(table.name, ", ".join(frame.columns)), buffer)
+    else:
+        # Missing values have to be passed as None rather than NaN to be stored as NULL
+        frame = frame.astype(object).where(frame.notnull(), None)
+        connection.execute(table.insert(), frame.to_dict("records"))
 
-    food_descriptions = pandas.read_csv(food_description_file, quotechar='~', delimiter='^', encoding='latin-1',
-                                        header=None, names=food_description_columns)
-    nutrient_definitions = pandas.read_csv(nutrient_definition_file, quotechar='~', delimiter='^', encoding='latin-1',
-                                           header=None, names=nutrient_definition_columns)
-    nutrition_data = pandas.read_csv(nutrition_data_file, quotechar='~', delimiter='^', encoding='latin-1', header=None,
-                                     names=nutrition_data_columns)
-    weight_data = pandas.read_csv(weight_data_file, quotechar='~', delimiter='^', encoding='latin-1', header=None,
-                                  names=weight_data_columns)
+
+def read_usda_file(path, columns, **kwargs):
+    return pandas.read_csv(path, quotechar='~', delimiter='^', encoding='latin-1', header=None, names=columns, **kwargs)
+
+
+def build_tables(data_dir):
+    """Reads the small USDA files into DataFrames shaped like the ingredient, ingredient_name, nutrient and
+    ingredient_preparation tables."""
+    food_descriptions = read_usda_file(os.path.join(data_dir, "FOOD_DES.txt"), food_description_columns)
+    nutrient_definitions = read_usda_file(os.path.join(data_dir, "NUTR_DEF.txt"), nutrient_definition_columns)
+    weight_data = read_usda_file(os.path.join(data_dir, "WEIGHT.txt"), weight_data_columns)
 
     # Pandas is retarded when it comes to handling text in csv files...
     food_descriptions.fillna('', inplace=True)
     nutrient_definitions.fillna('', inplace=True)
-    nutrition_data.fillna('', inplace=True)
     weight_data.fillna('', inplace=True)
 
+    food_descriptions = food_descriptions[~food_descriptions.food_group.isin(ignored_food_groups)]
+    ingredient_ids = food_descriptions.ndb_id.astype("int64")
+    ingredients = pandas.DataFrame({"ingredient_id": ingredient_ids})
+    ingredient_names = pandas.DataFrame({"ingredient_id": ingredient_ids,
+                                         "name": food_descriptions.description,
+                                         "canonical": True})
+
+    nutrient_ids = nutrient_definitions.nutrient_id.astype("int64")
+    nutrients = pandas.DataFrame({
+        "nutrient_id": nutrient_ids,
+        "display_name": nutrient_ids.map(nutrient_display_names),
+        "scientific_name": nutrient_ids.map(nutrient_scientific_names),
+        "measurement_unit": nutrient_definitions.units,
+        "recommended_daily_intake": nutrient_ids.map(nutrient_rdi).astype("float64"),
+        "display": nutrient_ids.map(lambda nutrient_id: display_nutrient.get(nutrient_id, False))
+    })
+
+    # Measure descriptions repeat thousands of times, so each distinct one is resolved to a volume once and the
+    # densities are then computed for every row at once
+    weight_data = weight_data[weight_data.ndb_id.isin(ingredient_ids)]
+    resolutions = {measure: units.resolve_measure(measure) for measure in weight_data.measure_description.unique()}
+    measures = weight_data.measure_description
+    weight_data = weight_data[measures.map(lambda measure: resolutions[measure].keep).astype(bool)]
+    measures = weight_data.measure_description
+    cubic_meters = measures.map(lambda measure: resolutions[measure].cubic_meters).astype("float64")
+    # Convert the gram weight to kilograms so density is in standard units
+    density = weight_data.gram_weight / 1000 / (weight_data.amount * cubic_meters)
+    ingredient_preparations = pandas.DataFrame({
+        "ingredient_id": weight_data.ndb_id.astype("int64"),
+        "sequence": weight_data.sequence.astype("int64"),
+        "description": measures.map(lambda measure: resolutions[measure].description),
+        "density": density,
+        "amount": weight_data.amount.astype("float64"),
+        "weight": weight_data.gram_weight.astype("float64")
+    })
+    return ingredients, ingredient_names, nutrients, ingredient_preparations
+
+
+def iter_ingredient_nutrients(data_dir, ingredient_ids, chunk_size):
+    """Streams NUT_DATA.txt, by far the largest file, in chunks shaped like the ingredient_nutrient table."""
+    chunks = read_usda_file(os.path.join(data_dir, "NUT_DATA.txt"), nutrition_data_columns, usecols=[0, 1, 2],
+                            chunksize=chunk_size)
+    for chunk in chunks:
+        chunk = chunk[chunk.ndb_id.isin(ingredient_ids)]
+        yield pandas.DataFrame({
+            "ingredient_id": chunk.ndb_id.astype("int64"),
+            "nutrient_id": chunk.nutrient_id.astype("int64"),
+            "quantity": chunk.nutrient_value.astype("float64")
+        })
+
+
+def row_hashes(frame):
+    # Text columns may hold None or NaN for missing values depending on where they came from
+    normalized = frame.astype(object).where(frame.notnull(), None)
+    return pandas.util.hash_pandas_object(normalized, index=False).values
+
+
+def changed_rows(incoming, table, key, where=None):
+    """Returns the rows of incoming that are missing from table or whose content hash differs from the stored row
+    with the same key.  Only stored rows within the range of incoming's first key column are read, so a chunk of a
+    large table is compared without loading the rest of it."""
+    if incoming.empty:
+        return incoming
+    columns = list(incoming.columns)
+    first = incoming[key[0]]
+    select = db.select([table.c[column] for column in columns])\
+        .where(table.c[key[0]].between(int(first.min()), int(first.max())))
+    if where is not None:
+        select = select.where(where)
+    existing = pandas.read_sql(select, db.session.connection())
+    existing = existing[existing[key[0]].isin(first)].astype(incoming.dtypes.to_dict())
+    existing_hashes = pandas.DataFrame({"_existing_hash": row_hashes(existing)})
+    existing_hashes[key] = existing[key]
+    # A key matching several stored rows would repeat incoming rows in the merge
+    existing_hashes = existing_hashes.drop_duplicates(key)
+    merged = incoming.assign(_hash=row_hashes(incoming)).merge(existing_hashes, on=key, how="left")
+    return incoming[(merged._hash != merged._existing_hash).values]
+
+
+def upsert(table, frame, key, chunk_size):
+    """Writes frame with INSERT ... ON CONFLICT in short transactions, so the import can run under live traffic."""
+    connection = db.session.connection()
+    updated = [column for column in frame.columns if column not in key]
+    if connection.dialect.name == "postgresql":
+        statement = postgresql.insert(table)
+        if updated:
+            statement = statement.on_conflict_do_update(index_elements=key,
+                                                        set_={column: statement.excluded[column] for column in updated})
+        else:
+            statement = statement.on_conflict_do_nothing(index_elements=key)
+    else:
+        # SQLite 3.24+; unlike INSERT OR REPLACE, which deletes the stored row, this keeps the columns frame lacks
+        action = "UPDATE SET " + ", ".join("{0} = excluded.{0}".format(column) for column in updated) \
+            if updated else "NOTHING"
+        statement = db.text("INSERT INTO {} ({}) VALUES ({}) ON CONFLICT ({}) DO {}".format(
+            table.name, ", ".join(frame.columns), ", ".join(":" + column for column in frame.columns), ", ".join(key),
+            action))
+    frame = frame.astype(object).where(frame.notnull(), None)
+    for start in range(0, len(frame), chunk_size):
+        db.session.execute(statement, frame.iloc[start:start + chunk_size].to_dict("records"))
+        db.session.commit()
+
+
+def number_measures(ingredient_preparations, chunk_size):
+    """Measures imported before the USDA sequence number was recorded have none, so they would never conflict with
+    the incoming measures and be inserted again.  Each is given the sequence of the incoming measure of the same
+    ingredient with the same amount and weight instead."""
+    table = models.IngredientMeasure.__table__
+    connection = db.session.connection()
+    unnumbered = pandas.read_sql(db.select([table.c.ingredient_preparation_id, table.c.ingredient_id, table.c.amount,
+                                            table.c.weight]).where(table.c.sequence.is_(None)), connection)
+    if unnumbered.empty:
+        return 0
+    numbered = pandas.read_sql(db.select([table.c.ingredient_id, table.c.sequence])
+                               .where(table.c.sequence.isnot(None)), connection).astype("int64")
+    # Sequences that are already stored can't be given out again
+    candidates = ingredient_preparations[["ingredient_id", "sequence", "amount", "weight"]]\
+        .merge(numbered, on=["ingredient_id", "sequence"], how="left", indicator=True)
+    candidates = candidates[candidates._merge == "left_only"].drop(columns="_merge")
+    # Measures that look alike are paired up in the order they were imported
+    natural_key = ["ingredient_id", "amount", "weight"]
+    unnumbered = unnumbered.sort_values("ingredient_preparation_id")
+    unnumbered["_repeat"] = unnumbered.groupby(natural_key).cumcount()
+    candidates = candidates.sort_values("sequence")
+    candidates["_repeat"] = candidates.groupby(natural_key).cumcount()
+    matches = unnumbered.merge(candidates, on=natural_key + ["_repeat"])
+    update = table.update()\
+        .where(table.c.ingredient_preparation_id == db.bindparam("_ingredient_preparation_id"))\
+        .values(sequence=db.bindparam("sequence"))
+    rows = [{"_ingredient_preparation_id": int(row.ingredient_preparation_id), "sequence": int(row.sequence)}
+            for row in matches.itertuples()]
+    for start in range(0, len(rows), chunk_size):
+        db.session.execute(update, rows[start:start + chunk_size])
+        db.session.commit()
+    return len(rows)
+
+
+def update_canonical_names(ingredient_names, chunk_size):
+    """ingredient_name has no natural key to upsert on, so changed canonical names are updated in place."""
+    table = models.IngredientName.__table__
+    canonical = table.c.canonical == db.true()
+    existing_ids = set(e[0] for e in db.session.execute(db.select([table.c.ingredient_id]).where(canonical)))
+    changed = changed_rows(ingredient_names, table, ["ingredient_id"], canonical) if existing_ids else ingredient_names
+    new_names = changed[~changed.ingredient_id.isin(existing_ids)]
+    renamed = changed[changed.ingredient_id.isin(existing_ids)]
+    update = table.update()\
+        .where(db.and_(table.c.ingredient_id == db.bindparam("_ingredient_id"), canonical))\
+        .values(name=db.bindparam("name"))
+    rows = [{"_ingredient_id": int(row.ingredient_id), "name": row.name} for row in renamed.itertuples()]
+    for start in range(0, len(rows), chunk_size):
+        db.session.execute(update, rows[start:start + chunk_size])
+        db.session.commit()
+    bulk_load(table, new_names)
+    db.session.commit()
+    # Core inserts and updates bypass the listener that adds names to the matcher's index
+    matching.ingredient_matcher.refresh()
+    return len(new_names) + len(renamed)
+
+
+def main(data_dir, chunk_size=100000):
+    ingredients, ingredient_names, nutrients, ingredient_preparations = build_tables(data_dir)
     with app.test_request_context():
-        ingredients = {}
-        ingredient_preparations = []
-        nutrients = {}
-        ingredient_nutrients = []
-
-        for entry in food_descriptions.itertuples():
-            if entry.food_group in ignored_food_groups:
-                continue
-            ingredient = models.Ingredient(ingredient_id=int(entry.ndb_id))
-            ingredients[entry.ndb_id] = ingredient
-            ingredient.names.append(models.IngredientName(name=entry.description, canonical=True))
-
-        for entry in nutrient_definitions.itertuples():
-            nutrient_id = int(entry.nutrient_id)
-            display_name = nutrient_display_names.get(nutrient_id)
-            scientific_name = nutrient_scientific_names.get(nutrient_id)
-            recommended_daily_intake = nutrient_rdi.get(nutrient_id)
-            display = display_nutrient.get(nutrient_id, False)
-            nutrient = models.Nutrient(nutrient_id=nutrient_id, display_name=display_name,
-                                       scientific_name=scientific_name, measurement_unit=entry.units,
-                                       recommended_daily_intake=recommended_daily_intake, display=display)
-            nutrients[nutrient_id] = nutrient
-
-        # Most entries in the weights file conform to this pattern
-        weight_re = re.compile(r"([\w\s]+?)(?:\s+\(.*\))?(?:,\s+(.*))?\Z")
-        for weight_entry in weight_data.itertuples():
-            if weight_entry.ndb_id not in ingredients:
-                continue
-            # Pint thinks fl oz is femtolitre ounces
-            if weight_entry.measure_description == "fl oz":
-                description = "fluid ounces"
-                # US regulation defines a fluid ounce as equivalent to 30mL for nutrition labeling purposes
-                volume = weight_entry.amount * ureg.parse_expression("30 ml").to_base_units()
-                # Convert the gram weight to kilograms so density is in standard units
-                mass = weight_entry.gram_weight / 1000 * ureg.kilogram
-                density = float((mass / volume).magnitude)
-            # Special case, as pat matches a unit, but in this context should not be interpreted as such
-            elif weight_entry.measure_description.startswith("pat "):
-                description = weight_entry.measure_description
-                density = None
-            else:
-                match = weight_re.match(weight_entry.measure_description)
-                if match:
-                    (unit_name, preparation) = match.groups()
-                    # First determine that this weight contains units rather than something nebulous like a "serving"
-                    try:
-                        quantity = weight_entry.amount * ureg.parse_expression(unit_name)
-                        description = preparation
-                        # Convert to base units so volume measurements are in cubic meters
-                        volume = quantity.to_base_units()
-                        # Discard entries with non-volume measurements
-                        if not volume.units.get("meter") == 3:
-                            continue
-                        # Convert the gram weight to kilograms so density is in standard units
-                        mass = weight_entry.gram_weight / 1000 * ureg.kilogram
-                        density = float((mass / volume).magnitude)
-                    except UndefinedUnitError:
-                        description = weight_entry.measure_description
-                        density = None
-                else:
-                    description = weight_entry.measure_description
-                    density = None
-            ingredient_preparation = models.IngredientMeasure(ingredient_id=int(weight_entry.ndb_id),
-                                                              description=description, density=density,
-                                                              amount=float(weight_entry.amount),
-                                                              weight=float(weight_entry.gram_weight))
-            ingredient_preparations.append(ingredient_preparation)
-
-        for entry in nutrition_data.itertuples():
-            if entry.ndb_id not in ingredients:
-                continue
-            ingredient_nutrient = models.IngredientNutrient(nutrient_id=int(entry.nutrient_id),
-                                                            ingredient_id=int(entry.ndb_id),
-                                                            quantity=float(entry.nutrient_value))
-            ingredient_nutrients.append(ingredient_nutrient)
-        db.session.add_all(ingredients.values())
-        db.session.add_all(nutrients.values())
+        bulk_load(models.Ingredient.__table__, ingredients)
+        bulk_load(models.Nutrient.__table__, nutrients)
         db.session.commit()
 
-        db.session.add_all(ingredient_preparations)
-        db.session.add_all(ingredient_nutrients)
+        bulk_load(models.IngredientName.__table__, ingredient_names)
+        bulk_load(models.IngredientMeasure.__table__, ingredient_preparations)
+        db.session.commit()
+        # Core inserts bypass the listener that adds names to the matcher's index
+        matching.ingredient_matcher.refresh()
+
+        for ingredient_nutrients in iter_ingredient_nutrients(data_dir, ingredients.ingredient_id, chunk_size):
+            bulk_load(models.IngredientNutrient.__table__, ingredient_nutrients)
+        models.DataVersion.bump(nutrition.data_version_name)
+        db.session.commit()
+
+
+def main_incremental(data_dir, chunk_size=100000, transaction_size=1000):
+    """Brings an already populated database up to date with a new SR release, writing only new or changed rows.
+    Returns the number of rows written to each table."""
+    ingredients, ingredient_names, nutrients, ingredient_preparations = build_tables(data_dir)
+    written = {}
+    with app.test_request_context():
+        measures = models.IngredientMeasure.__table__
+        numbered = number_measures(ingredient_preparations, transaction_size)
+        if numbered:
+            print("{}: {} measures numbered".format(measures.name, numbered))
+        tables = ((models.Ingredient.__table__, ingredients, ["ingredient_id"], None),
+                  (models.Nutrient.__table__, nutrients, ["nutrient_id"], None),
+                  (measures, ingredient_preparations, ["ingredient_id", "sequence"], measures.c.sequence.isnot(None)))
+        for (table, incoming, key, where) in tables:
+            changed = changed_rows(incoming, table, key, where)
+            upsert(table, changed, key, transaction_size)
+            written[table.name] = len(changed)
+        written[models.IngredientName.__tablename__] = update_canonical_names(ingredient_names, transaction_size)
+
+        table = models.IngredientNutrient.__table__
+        written[table.name] = 0
+        for ingredient_nutrients in iter_ingredient_nutrients(data_dir, ingredients.ingredient_id, chunk_size):
+            changed = changed_rows(ingredient_nutrients, table, ["ingredient_id", "nutrient_id"])
+            upsert(table, changed, ["ingredient_id", "nutrient_id"], transaction_size)
+            written[table.name] += len(changed)
+        for (name, count) in written.items():
+            print("{}: {} rows written".format(name, count))
+
+        # Recipe nutrition rollups are recomputed on their next read, from a nutrient matrix that servers reload
+        # when they see the new data version
+        db.session.execute(models.RecipeNutrition.__table__.delete())
+        models.DataVersion.bump(nutrition.data_version_name)
         db.session.commit()
+    return written
 
 
 if __name__ == "__main__":
     import argparse
     parser = argparse.ArgumentParser()
     parser.add_argument("data_dir")
+    parser.add_argument("--chunk-size", type=int, default=100000)
+    parser.add_argument("--incremental", action="store_true",
+                        help="Upsert only new or changed rows into an already populated database")
+    parser.add_argument("--transaction-size", type=int, default=1000,
+                        help="Rows written per transaction in incremental mode")
     args = parser.parse_args()
-    main(args.data_dir)
+    if args.incremental:
+        main_incremental(args.data_dir, args.chunk_size, args.transaction_size)
+    else:
+        main(args.data_dir, args.chunk_size)
@@ -0,0 +1,119 @@
+import pytest
+
+from metarecipe import matching, models
+from metarecipe.app import db
+
+units = {"cup", "cups", "tablespoon", "tablespoons", "teaspoon", "teaspoons", "pound", "pounds", "ounce", "clove",
+         "cloves", "stick", "sticks"}
+
+
+def delete_documents(app, urls):
+    documents = models.RecipeDocument.__table__
+    with app.app_context():
+        document_ids = db.select([documents.c.recipe_document_id]).where(documents.c.url.in_(urls))
+        for model in (models.RecipeDocumentWordTag, models.RecipeDocumentTagSet, models.RecipeDocumentWord):
+            table = model.__table__
+            db.session.execute(table.delete().where(table.c.recipe_document_id.in_(document_ids)))
+        db.session.execute(documents.delete().where(documents.c.url.in_(urls)))
+        db.session.commit()
+
+
+def delete_tags(app, document_id):
+    tags = models.RecipeDocumentWordTag.__table__
+    with app.app_context():
+        db.session.execute(tags.delete().where(tags.c.recipe_document_id == document_id))
+        db.session.commit()
+    models.RecipeDocumentTagSet.invalidate_groups()
+
+
+def recipe_tags(client, document_id):
+    """Tags a document the way a person would: the heading is the title, list items are ingredient lines and
+    paragraphs are directions, between the heading and the reviews."""
+    words = client.get("/crud/recipe_document/{}/words/".format(document_id)).get_json()["words"]
+    tags = []
+    in_recipe = False
+    for word in words:
+        if word["element_tag"] == "h1":
+            in_recipe = True
+            tag = "title"
+        elif not in_recipe:
+            continue
+        elif word["word"] == "Reviews":
+            break
+        elif word["element_tag"] == "li":
+            if word["word"] == "#":
+                tag = "ingredient-quantity"
+            elif word["word"] in units:
+                tag = "ingredient-units"
+            elif word["word"].isalpha():
+                tag = "ingredient-name"
+            else:
+                continue
+        elif word["element_tag"] == "p":
+            tag = "directions"
+        else:
+            continue
+        tags.append({"recipe_document_word_id": word["recipe_document_word_id"], "tag": tag})
+    return tags
+
+
+@pytest.fixture(scope="session")
+def documents(database, fixture_fetcher, recipe_pages):
+    """Document ids of the saved pages, by file name."""
+    client = database.test_client()
+    response = client.post("/search/retrieve/", json=[{"url": "http://fixtures.metarecipe/" + name}
+                                                      for name in recipe_pages])
+    return {document["url"].rsplit("/", 1)[-1]: document["recipe_document_id"]
+            for document in response.get_json()["recipe_documents"]}
+
+
+@pytest.fixture(scope="session")
+def tag_set_id(database, documents):
+    client = database.test_client()
+    document_id = documents["food_network_lasagna.html"]
+    client.post("/crud/recipe_document_word_tag/", json=recipe_tags(client, document_id))
+    with database.app_context():
+        return models.RecipeDocumentTagSet.query.filter_by(recipe_document_id=document_id).one()\
+            .recipe_document_tagset_id
+
+
+@pytest.mark.benchmark(group="endpoints")
+def bench_retrieve(benchmark, database, client, fixture_fetcher, recipe_pages):
+    urls = ["http://fixtures.metarecipe/retrieve/" + name for name in recipe_pages]
+    response = benchmark.pedantic(client.post, args=("/search/retrieve/",),
+                                  kwargs={"json": [{"url": url} for url in urls]},
+                                  setup=lambda: delete_documents(database, urls), rounds=20)
+    assert len(response.get_json()["recipe_documents"]) == len(urls)
+
+
+@pytest.mark.benchmark(group="endpoints")
+def bench_create_tags(benchmark, database, client, documents):
+    document_id = documents["food_com_cookies.html"]
+    tags = recipe_tags(client, document_id)
+    response = benchmark.pedantic(client.post, args=("/crud/recipe_document_word_tag/",), kwargs={"json": tags},
+                                  setup=lambda: delete_tags(database, document_id), rounds=20)
+    assert len(response.get_json()["tags"]) == len(tags)
+
+
+@pytest.mark.benchmark(group="endpoints")
+def bench_list_tags(benchmark, client, documents, tag_set_id):
+    url = "/crud/recipe_document_word_tag/?recipe_document_id={}".format(documents["food_network_lasagna.html"])
+    assert benchmark(client.get, url).get_json()["tags"]
+
+
+def forget_recipe():
+    models.RecipeDocumentTagSet.invalidate_groups()
+    matching.ingredient_matcher.clear()
+
+
+@pytest.mark.benchmark(group="recipe_from_tag_set")
+def bench_recipe_from_tag_set(benchmark, client, tag_set_id):
+    url = "/recipe_creation/tag_set/{}/".format(tag_set_id)
+    response = benchmark.pedantic(client.get, args=(url,), setup=forget_recipe, rounds=50)
+    assert response.get_json()["ingredients"]
+
+
+@pytest.mark.benchmark(group="recipe_from_tag_set")
+def bench_recipe_from_tag_set_memoized(benchmark, client, tag_set_id):
+    url = "/recipe_creation/tag_set/{}/".format(tag_set_id)
+    assert benchmark(client.get, url).get_json()["ingredients"]
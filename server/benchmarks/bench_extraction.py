@@ -0,0 +1,25 @@
+import pytest
+
+from metarecipe import extractors, models
+
+
+@pytest.fixture(params=["food_com_cookies.html", "food_network_lasagna.html"])
+def page(request, recipe_pages):
+    return recipe_pages[request.param]
+
+
+@pytest.mark.benchmark(group="extraction")
+def bench_get_document_words(benchmark, page):
+    words = benchmark(models.RecipeDocument.get_document_words, page)
+    assert words
+
+
+@pytest.mark.benchmark(group="extraction")
+def bench_sanitize_html(benchmark, page):
+    assert benchmark(extractors.HTMLExtractor._sanitize_html, page)
+
+
+@pytest.mark.benchmark(group="extraction")
+def bench_extract(benchmark, page):
+    (title, safe_html, words) = benchmark(extractors.HTMLExtractor.extract, page)
+    assert title and words
@@ -0,0 +1,70 @@
+import pytest
+
+import import_usda_nutrition
+from metarecipe import models
+from metarecipe.app import db
+
+
+def clear_usda_tables(app):
+    with app.app_context():
+        for model in (models.IngredientNutrient, models.IngredientMeasure, models.IngredientName, models.Nutrient,
+                      models.Ingredient):
+            db.session.execute(model.__table__.delete())
+        db.session.commit()
+
+
+def count_rows(app, model):
+    with app.app_context():
+        return db.session.query(model).count()
+
+
+def ensure_imported(app, data_dir):
+    if not count_rows(app, models.Ingredient):
+        import_usda_nutrition.main(data_dir)
+
+
+@pytest.mark.benchmark(group="usda_import")
+def bench_usda_import(benchmark, database, usda_data_dir):
+    benchmark.pedantic(import_usda_nutrition.main, args=(usda_data_dir,), setup=lambda: clear_usda_tables(database),
+                       rounds=3)
+    assert count_rows(database, models.IngredientNutrient)
+
+
+@pytest.mark.benchmark(group="usda_import")
+def bench_usda_incremental_import(benchmark, database, usda_data_dir):
+    # Nothing has changed since the full import, which is the common case for a new release
+    ensure_imported(database, usda_data_dir)
+    written = benchmark.pedantic(import_usda_nutrition.main_incremental, args=(usda_data_dir,), rounds=3)
+    assert not any(written.values())
+
+
+def change_one_nutrient(app):
+    with app.app_context():
+        table = models.IngredientNutrient.__table__
+        first_id = db.session.execute(db.select([db.func.min(table.c.ingredient_nutrient_id)])).scalar()
+        db.session.execute(table.update().where(table.c.ingredient_nutrient_id == first_id)
+                           .values(quantity=table.c.quantity + 1))
+        db.session.commit()
+
+
+@pytest.mark.benchmark(group="usda_import")
+def bench_usda_incremental_import_with_change(benchmark, database, usda_data_dir):
+    # Only the changed row is written back, restoring the release's value
+    ensure_imported(database, usda_data_dir)
+    written = benchmark.pedantic(import_usda_nutrition.main_incremental, args=(usda_data_dir,),
+                                 setup=lambda: change_one_nutrient(database), rounds=3)
+    assert written[models.IngredientNutrient.__tablename__] == 1
+    assert sum(written.values()) == 1
+
+
+@pytest.mark.benchmark(group="usda_import")
+def bench_usda_incremental_import_with_alias(benchmark, database, usda_data_dir):
+    # An alias shares its ingredient's id with the canonical name, and isn't a change to it
+    ensure_imported(database, usda_data_dir)
+    with database.app_context():
+        ingredient_id = db.session.query(models.Ingredient.ingredient_id).first()[0]
+        db.session.add(models.IngredientName(ingredient_id=ingredient_id, name="alias", canonical=False))
+        db.session.commit()
+    written = benchmark.pedantic(import_usda_nutrition.main_incremental, args=(usda_data_dir,), rounds=3)
+    assert written[models.IngredientName.__tablename__] == 0
+    assert count_rows(database, models.IngredientName) == count_rows(database, models.Ingredient) + 1
@@ -0,0 +1,145 @@
+"""Benchmarks of the hot paths of the server, run with pytest-benchmark from the server directory:
+
+    python -m pytest benchmarks --benchmark-autosave
+
+Each run is saved under .benchmarks with the commit it was made at, and later runs can be compared against it, failing
+on a regression:
+
+    python -m pytest benchmarks --benchmark-compare --benchmark-compare-fail=median:15%
+
+The database benchmarks run against a scratch SQLite database, and also against PostgreSQL when given the url of a
+database they are free to wipe with --postgresql (or METARECIPE_BENCHMARK_POSTGRESQL).  Remote sites are never
+contacted: fetches are answered with the pages in benchmarks/fixtures."""
+import os
+import random
+import sys
+import tempfile
+
+import pytest
+
+server_path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+fixtures_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+weight_path = os.path.join(server_path, "..", "data", "usda_nutrition", "WEIGHT.txt")
+sys.path[:0] = [server_path, os.path.join(server_path, "..", "scripts")]
+
+
+def pytest_addoption(parser):
+    parser.addoption("--postgresql", default=os.environ.get("METARECIPE_BENCHMARK_POSTGRESQL"),
+                     help="Url of a PostgreSQL database to benchmark against.  Everything in it is dropped.")
+    parser.addoption("--usda-foods", type=int, default=500,
+                     help="Number of foods from WEIGHT.txt in the synthetic USDA release")
+
+
+def pytest_configure(config):
+    # The app reads its config when it is first imported, so this has to exist before any benchmark module loads
+    config_path = os.path.join(tempfile.mkdtemp(prefix="metarecipe-benchmark-"), "config.py")
+    with open(config_path, "w") as f:
+        f.write("SQLALCHEMY_DATABASE_URI = 'sqlite://'\nSQLALCHEMY_TRACK_MODIFICATIONS = False\n")
+    os.environ["metarecipe_config"] = config_path
+
+
+class FixtureResponse(object):
+
+    def __init__(self, text):
+        self.text = text
+        self.content = text.encode("utf-8") if text is not None else b""
+        self.status_code = 200 if text is not None else 404
+        self.ok = text is not None
+
+
+class FixtureSession(object):
+    """Stands in for the fetcher's requests session, serving saved pages by url."""
+
+    def __init__(self, pages):
+        self.pages = pages
+
+    def get(self, url, **kwargs):
+        # Any url ending in the name of a saved page serves it, so benchmarks can use urls of their own
+        return FixtureResponse(self.pages.get(url.rsplit("/", 1)[-1]))
+
+
+@pytest.fixture(scope="session")
+def recipe_pages():
+    """The saved pages by file name."""
+    pages = {}
+    for name in sorted(os.listdir(fixtures_path)):
+        with open(os.path.join(fixtures_path, name), encoding="utf-8") as f:
+            pages[name] = f.read()
+    return pages
+
+
+@pytest.fixture(scope="session")
+def fixture_fetcher(recipe_pages):
+    from metarecipe import fetch
+    session = fetch.shared_fetcher.session
+    fetch.shared_fetcher.session = FixtureSession(recipe_pages)
+    yield fetch.shared_fetcher
+    fetch.shared_fetcher.session = session
+
+
+@pytest.fixture(scope="session", params=["sqlite", "postgresql"])
+def database(request, tmp_path_factory):
+    """Points the app at an empty, fully migrated database of each kind, yielding the app."""
+    if request.param == "sqlite":
+        uri = "sqlite:///" + str(tmp_path_factory.mktemp("sqlite") / "benchmark.db")
+    else:
+        uri = request.config.getoption("postgresql")
+        if not uri:
+            pytest.skip("no PostgreSQL database given")
+    from alembic import command
+    from alembic.config import Config
+    from metarecipe import matching, models, nutrition
+    from metarecipe.app import app, db
+    app.config["SQLALCHEMY_DATABASE_URI"] = uri
+    db.metadata.bind = uri
+    migrations = Config(os.path.join(server_path, "alembic.ini"))
+    migrations.set_main_option("script_location", os.path.join(server_path, "migrations"))
+    with app.app_context():
+        command.downgrade(migrations, "base")
+        command.upgrade(migrations, "head")
+        db.session.remove()
+    # Nothing cached from the previous database may leak into this one
+    matching.ingredient_matcher.index = None
+    matching.ingredient_matcher.clear()
+    nutrition.reset_nutrient_matrix()
+    models.RecipeDocumentTagSet.invalidate_groups()
+    yield app
+    with app.app_context():
+        db.session.remove()
+
+
+@pytest.fixture
+def client(database):
+    return database.test_client()
+
+
+@pytest.fixture(scope="session")
+def usda_data_dir(request, tmp_path_factory):
+    """A synthetic SR release for the first --usda-foods foods of the real WEIGHT.txt, so that the measures (and so
+    the unit resolution work) are real while the other files are generated with a fixed seed."""
+    foods = request.config.getoption("usda_foods")
+    data_dir = tmp_path_factory.mktemp("usda")
+    ndb_ids = []
+    with open(weight_path, encoding="latin-1") as source, open(data_dir / "WEIGHT.txt", "w",
+                                                               encoding="latin-1") as weights:
+        for line in source:
+            ndb_id = line.split("^", 1)[0].strip("~")
+            if not ndb_ids or ndb_ids[-1] != ndb_id:
+                if len(ndb_ids) == foods:
+                    break
+                ndb_ids.append(ndb_id)
+            weights.write(line)
+    nutrient_ids = list(range(203, 263)) + list(range(301, 341)) + list(range(601, 641))
+    with open(data_dir / "FOOD_DES.txt", "w", encoding="latin-1") as f:
+        for ndb_id in ndb_ids:
+            f.write("~{0}~^~{1}00~^~Food {0}, raw~^~FOOD {0}~^^^~Y~^^0^^6.25^4^9^4\n".format(ndb_id, ndb_id[:2]))
+    with open(data_dir / "NUTR_DEF.txt", "w", encoding="latin-1") as f:
+        for nutrient_id in nutrient_ids:
+            f.write("~{0}~^~g~^~N{0}~^~Nutrient {0}~^~2~^~{0}~\n".format(nutrient_id))
+    values = random.Random(0)
+    with open(data_dir / "NUT_DATA.txt", "w", encoding="latin-1") as f:
+        for ndb_id in ndb_ids:
+            for nutrient_id in nutrient_ids:
+                f.write("~{}~^~{}~^{:.3f}^1^^~1~^~~^^^^^^^^^^~01/2001~^\n".format(ndb_id, nutrient_id,
+                                                                                   values.uniform(0, 100)))
+    return str(data_dir)
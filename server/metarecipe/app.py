@@ -1,5 +1,12 @@
 from flask import Flask
 from . import endpoints
+from . import archive
+from . import search
+from . import cache
+from . import matching
+from . import nutrition
+from . import instrumentation
+from . import jobs
 from .models import db
 
 
@@ -7,9 +14,29 @@ app = Flask(__name__, static_folder='../../client/', static_url_path='/client')
 app.config.from_envvar("metarecipe_config")
 app.register_blueprint(endpoints.recipe_search, url_prefix='/search')
 app.register_blueprint(endpoints.crud, url_prefix='/crud')
+app.register_blueprint(endpoints.recipe_creation, url_prefix='/recipe_creation')
+
+if app.config.get("HTML_ARCHIVE_PATH"):
+    archive.storage = archive.DiskArchive(app.config["HTML_ARCHIVE_PATH"], archive.DatabaseArchive())
+
+if app.config.get("SEARCH_CACHE_PATH"):
+    search.BaseSearch.response_cache = cache.TieredCache(search.BaseSearch.response_cache,
+                                                         cache.SQLiteCache(app.config["SEARCH_CACHE_PATH"]))
+
+if app.config.get("INGREDIENT_INDEX_PATH"):
+    matching.ingredient_matcher.index = matching.TrigramIndex.load(app.config["INGREDIENT_INDEX_PATH"])
+
+if app.config.get("NUTRIENT_MATRIX_PATH"):
+    nutrition.matrix_path = app.config["NUTRIENT_MATRIX_PATH"]
+
+if app.config.get("RETRIEVAL_JOB_WORKERS") or app.config.get("RETRIEVAL_JOB_PROCESSES"):
+    jobs.backend = jobs.create_backend(app.config.get("RETRIEVAL_JOB_WORKERS", 2),
+                                       app.config.get("RETRIEVAL_JOB_PROCESSES", False))
+
+if app.config.get("INSTRUMENTATION"):
+    instrumentation.init_app(app)
 
 db.init_app(app)
 db.metadata.bind = app.config["SQLALCHEMY_DATABASE_URI"]
 
-# db.metadata.drop_all()
-# db.metadata.create_all()
+# The schema is managed by the migrations in ../migrations, see alembic.ini
@@ -0,0 +1,179 @@
+"""Content-addressed storage of pages.  Every page is stored compressed under the SHA-256 of its bytes, so the raw
+pages documents were extracted from can be cleaned and tokenized again without downloading them, and identical pages
+are only stored once."""
+import gzip
+import hashlib
+import io
+import os
+import tempfile
+from itertools import chain
+
+from sqlalchemy import event
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.orm import Session
+
+from . import models
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+# Pages are written with zstd when it is installed and gzip otherwise, and are read back with whichever they were
+# written with
+codec = "zstd" if zstandard else "gzip"
+
+
+def page_key(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def compress(data, codec):
+    if codec == "zstd":
+        return zstandard.ZstdCompressor(level=3).compress(data)
+    return gzip.compress(data, compresslevel=6)
+
+
+def open_compressed(f, codec):
+    """Returns a binary file that decompresses f as it is read."""
+    if codec == "zstd":
+        return zstandard.ZstdDecompressor().stream_reader(f, closefd=True)
+    return gzip.GzipFile(fileobj=f, mode="rb")
+
+
+class DiskArchive(object):
+    """Stores pages as files named by their key under path, e.g. path/3f/3f2a...9c.gz.  Pages it doesn't have are
+    read from fallback if one is given, such as the DatabaseArchive that migration 0004 moved existing pages into."""
+
+    _extensions = {"zstd": ".zst", "gzip": ".gz"}
+
+    def __init__(self, path, fallback=None):
+        self.path = path
+        self.fallback = fallback
+
+    def _path(self, key, codec):
+        return os.path.join(self.path, key[:2], key + self._extensions[codec])
+
+    def _find(self, key):
+        for (codec, extension) in self._extensions.items():
+            path = self._path(key, codec)
+            if os.path.exists(path):
+                return path, codec
+        raise KeyError(key)
+
+    def store(self, pages, connection=None):
+        """Writes the pages, a dict of key to bytes, that aren't already stored."""
+        for (key, data) in pages.items():
+            try:
+                self._find(key)
+                continue
+            except KeyError:
+                pass
+            path = self._path(key, codec)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # Written to a temporary file and renamed into place, so readers never see part of a page
+            (fd, temporary_path) = tempfile.mkstemp(dir=os.path.dirname(path))
+            with os.fdopen(fd, "wb") as f:
+                f.write(compress(data, codec))
+            os.replace(temporary_path, path)
+
+    def open(self, key, connection=None):
+        try:
+            (path, page_codec) = self._find(key)
+        except KeyError:
+            if self.fallback is None:
+                raise
+            return self.fallback.open(key, connection)
+        return open_compressed(open(path, "rb"), page_codec)
+
+    def read_many(self, keys, connection=None):
+        """Returns the pages of the keys that are stored, by key."""
+        pages = {}
+        missing = []
+        for key in set(keys):
+            try:
+                (path, page_codec) = self._find(key)
+            except KeyError:
+                missing.append(key)
+                continue
+            with open_compressed(open(path, "rb"), page_codec) as f:
+                pages[key] = f.read()
+        if missing and self.fallback is not None:
+            pages.update(self.fallback.read_many(missing, connection))
+        return pages
+
+
+class DatabaseArchive(object):
+    """Stores pages in the archived_page table, in the same transaction as the documents that reference them."""
+
+    def store(self, pages, connection=None):
+        if not pages:
+            return
+        connection = connection or models.db.session.connection()
+        table = models.ArchivedPage.__table__
+        rows = [{"sha256": key, "codec": codec, "size": len(data), "content": compress(data, codec)}
+                for (key, data) in pages.items()]
+        if connection.dialect.name == "postgresql":
+            connection.execute(postgresql.insert(table).values(rows).on_conflict_do_nothing())
+            return
+        select = models.db.select([table.c.sha256]).where(table.c.sha256.in_(list(pages)))
+        present = set(row[0] for row in connection.execute(select).fetchall())
+        rows = [row for row in rows if row["sha256"] not in present]
+        if rows:
+            connection.execute(table.insert(), rows)
+
+    def _select(self, keys, connection):
+        table = models.ArchivedPage.__table__
+        select = models.db.select([table.c.sha256, table.c.codec, table.c.content]).where(table.c.sha256.in_(keys))
+        return (connection or models.db.session).execute(select).fetchall()
+
+    def open(self, key, connection=None):
+        rows = self._select([key], connection)
+        if not rows:
+            raise KeyError(key)
+        (key, page_codec, content) = rows[0]
+        return open_compressed(io.BytesIO(content), page_codec)
+
+    def read_many(self, keys, connection=None):
+        pages = {}
+        for (key, page_codec, content) in self._select(list(set(keys)), connection):
+            with open_compressed(io.BytesIO(content), page_codec) as f:
+                pages[key] = f.read()
+        return pages
+
+
+# Set from HTML_ARCHIVE_PATH in the app config to keep pages on disk instead of in the database
+storage = DatabaseArchive()
+
+
+def read(key, connection=None):
+    with storage.open(key, connection) as f:
+        return f.read()
+
+
+@event.listens_for(Session, "after_flush")
+def _store_pending_pages(session, flush_context):
+    # New and changed documents carry their pages (see RecipeDocument.html), and keep them once they are stored so
+    # that reading them back after the commit doesn't go to the archive.  They count as stored once the transaction
+    # commits, so a document flushed again after a rollback stores them again.
+    pending = {}
+    documents = []
+    for instance in chain(session.new, session.dirty):
+        if isinstance(instance, models.RecipeDocument) and instance._unstored_pages:
+            pending.update((key, instance._pages[key]) for key in instance._unstored_pages)
+            documents.append(instance)
+    if pending:
+        storage.store(pending, session.connection())
+        session.info.setdefault("metarecipe_archived_documents", []).extend(documents)
+
+
+@event.listens_for(Session, "after_commit")
+def _forget_stored_pages(session):
+    for document in session.info.pop("metarecipe_archived_documents", ()):
+        document._unstored_pages.clear()
+
+
+@event.listens_for(Session, "after_rollback")
+def _keep_unstored_pages(session):
+    session.info.pop("metarecipe_archived_documents", None)
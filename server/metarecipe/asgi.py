@@ -0,0 +1,155 @@
+"""ASGI serving mode, e.g. uvicorn metarecipe.asgi:application
+
+The search and retrieval routes, which spend nearly all of their time waiting on recipe sites, are served by
+coroutines sharing fetch.shared_async_fetcher's connection pool, so a slow upstream response only holds a socket.
+Every other route goes to the Flask app, whose synchronous handlers run on a thread pool."""
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qsl
+
+from asgiref.sync import ThreadSensitiveContext, sync_to_async
+from asgiref.wsgi import WsgiToAsgi
+from flask import json
+from werkzeug.exceptions import BadRequest, HTTPException
+
+from . import extractors
+from . import fetch
+from . import instrumentation
+from . import models
+from . import search
+from .app import app
+
+logger = logging.getLogger(__name__)
+
+_threads = app.config.get("ASGI_THREADS", 16)
+# Runs the database work of the async routes
+_executor = ThreadPoolExecutor(max_workers=_threads)
+_wsgi_application = WsgiToAsgi(app)
+# Created on first use, so that it belongs to the server's event loop
+_wsgi_slots = None
+
+
+async def _flask_application(scope, receive, send):
+    # asgiref runs every WSGI request on one shared thread unless it is in its own ThreadSensitiveContext, which
+    # would serialize the CRUD endpoints; at most ASGI_THREADS of them run at once
+    global _wsgi_slots
+    if _wsgi_slots is None:
+        _wsgi_slots = asyncio.Semaphore(_threads)
+    async with _wsgi_slots, ThreadSensitiveContext():
+        await _wsgi_application(scope, receive, send)
+
+
+def _run_in_app_context(function, *args):
+    with app.app_context():
+        return function(*args)
+
+
+async def _in_thread(function, *args):
+    return await sync_to_async(_run_in_app_context, thread_sensitive=False, executor=_executor)(function, *args)
+
+
+async def _read_json(receive):
+    body = b""
+    while True:
+        message = await receive()
+        body += message.get("body", b"")
+        if not message.get("more_body"):
+            break
+    return json.loads(body)
+
+
+async def _send_json(send, status, data, timings=None):
+    with instrumentation.phase("serialize"):
+        body = json.dumps(data, app=app).encode("utf-8")
+    headers = [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode())]
+    if timings is not None:
+        timings.status = status
+        headers.append((b"server-timing", instrumentation.server_timing(timings).encode("latin-1")))
+    await send({"type": "http.response.start", "status": status, "headers": headers})
+    await send({"type": "http.response.body", "body": body})
+
+
+async def _site_search(provider, args):
+    provider_search = provider(args.get("search"), args.get("page", 1))
+    results = await provider_search.get_results_page_async(provider_search.current_page)
+    return {"results": results, "next_page": provider_search.current_page + 1}
+
+
+async def food_network(args, receive):
+    return await _site_search(search.FoodNetworkSearch, args)
+
+
+async def food_com(args, receive):
+    return await _site_search(search.FoodComSearch, args)
+
+
+async def all_sites(args, receive):
+    try:
+        page = int(args.get("page", 1))
+        deadline = float(args.get("deadline", 5))
+    except ValueError:
+        raise BadRequest()
+    results, providers = await search.federated_search_async(args.get("search"), page, deadline)
+    return {"results": results, "providers": providers, "next_page": page + 1}
+
+
+def _present_urls(urls):
+    url_column = models.RecipeDocument.__table__.c.url
+    select = models.db.select([url_column]).where(url_column.in_(urls))
+    return set(e[0] for e in models.db.session.execute(select).fetchall())
+
+
+def _save_documents(recipe_documents):
+    models.db.session.add_all(recipe_documents)
+    models.db.session.commit()
+    return [document.as_dict for document in recipe_documents]
+
+
+async def retrieve(args, receive):
+    targeted_urls = [r.get("url") for r in await _read_json(receive)]
+    present_urls = await _in_thread(_present_urls, targeted_urls)
+    missing_urls = [url for url in dict.fromkeys(targeted_urls) if url not in present_urls]
+    results = await extractors.HTMLExtractor.from_urls_async(missing_urls)
+    failures = [{"url": result.url, "error": str(result.error)} for result in results if result.error]
+    recipe_documents = await _in_thread(_save_documents, [result.value for result in results if not result.error])
+    return {"recipe_documents": recipe_documents, "failures": failures}
+
+
+# The routes of endpoints.recipe_search that fetch from the recipe sites, by method and path
+routes = {
+    ("GET", "/search/site/food_network/"): food_network,
+    ("GET", "/search/site/food_com/"): food_com,
+    ("GET", "/search/all/"): all_sites,
+    ("POST", "/search/retrieve/"): retrieve,
+}
+
+
+async def _lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            await fetch.shared_async_fetcher.aclose()
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+async def application(scope, receive, send):
+    if scope["type"] == "lifespan":
+        return await _lifespan(receive, send)
+    handler = routes.get((scope.get("method"), scope.get("path"))) if scope["type"] == "http" else None
+    if handler is None:
+        return await _flask_application(scope, receive, send)
+    args = dict(parse_qsl(scope.get("query_string", b"").decode("latin-1")))
+    # Counted under the same endpoint names as the Flask versions of the routes
+    with instrumentation.timed_request("recipe_search." + handler.__name__) as timings:
+        try:
+            (status, data) = (200, await handler(args, receive))
+        except HTTPException as e:
+            (status, data) = (e.code, {"error": e.name})
+        except Exception:
+            logger.exception("Exception on %s [%s]", scope["path"], scope["method"])
+            (status, data) = (500, {"error": "Internal Server Error"})
+        await _send_json(send, status, data, timings)
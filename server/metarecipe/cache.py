@@ -0,0 +1,191 @@
+import sqlite3
+import threading
+import time
+from collections import namedtuple, OrderedDict, Counter
+from contextlib import contextmanager
+
+
+CachedResponse = namedtuple("CachedResponse", ["text", "etag", "last_modified", "timestamp"])
+
+
+class ResponseCache(object):
+    """Base class for stores of outbound HTTP responses.  Subclasses implement _load/_store/_evict; expiry and the
+    hit/miss accounting are handled here."""
+
+    def __init__(self, ttl=600):
+        self.ttl = ttl
+        self.stats = Counter()
+
+    def is_fresh(self, entry):
+        return time.time() - entry.timestamp < self.ttl
+
+    def get(self, key):
+        entry = self._load(key)
+        if entry is None:
+            self.stats["misses"] += 1
+        elif not self.is_fresh(entry) and not (entry.etag or entry.last_modified):
+            # Nothing to revalidate with, so the entry is useless once expired
+            self._evict(key)
+            self.stats["expired"] += 1
+            entry = None
+        return entry
+
+    def set(self, key, entry):
+        self._store(key, entry)
+
+    def _load(self, key):
+        raise NotImplementedError
+
+    def _store(self, key, entry):
+        raise NotImplementedError
+
+    def _evict(self, key):
+        raise NotImplementedError
+
+
+class MemoryCache(ResponseCache):
+    """In-process LRU cache."""
+
+    def __init__(self, ttl=600, max_entries=1000):
+        super().__init__(ttl)
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _load(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            return entry
+
+    def _store(self, key, entry):
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def _evict(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+
+class SQLiteCache(ResponseCache):
+    """On-disk cache, so that responses survive server restarts and are shared between worker processes."""
+
+    def __init__(self, path, ttl=86400):
+        super().__init__(ttl)
+        self.path = path
+        with self._connect() as connection:
+            connection.execute("CREATE TABLE IF NOT EXISTS response (key TEXT PRIMARY KEY, text TEXT, etag TEXT, "
+                               "last_modified TEXT, timestamp REAL)")
+
+    @contextmanager
+    def _connect(self):
+        """Yields a connection that is committed (or rolled back) and closed when the block exits."""
+        connection = sqlite3.connect(self.path, timeout=30)
+        try:
+            with connection:
+                yield connection
+        finally:
+            connection.close()
+
+    def _load(self, key):
+        with self._connect() as connection:
+            row = connection.execute("SELECT text, etag, last_modified, timestamp FROM response WHERE key = ?",
+                                     (key,)).fetchone()
+        return CachedResponse(*row) if row else None
+
+    def _store(self, key, entry):
+        with self._connect() as connection:
+            connection.execute("INSERT OR REPLACE INTO response VALUES (?, ?, ?, ?, ?)", (key,) + tuple(entry))
+
+    def _evict(self, key):
+        with self._connect() as connection:
+            connection.execute("DELETE FROM response WHERE key = ?", (key,))
+
+    def purge_expired(self):
+        with self._connect() as connection:
+            connection.execute("DELETE FROM response WHERE timestamp < ? AND etag IS NULL AND last_modified IS NULL",
+                               (time.time() - self.ttl,))
+
+
+class TieredCache(ResponseCache):
+    """Checks a fast cache before a slow one, promoting entries found in the slow cache."""
+
+    def __init__(self, fast, slow):
+        super().__init__(max(fast.ttl, slow.ttl))
+        self.fast = fast
+        self.slow = slow
+
+    def is_fresh(self, entry):
+        # Each tier judges freshness by its own ttl: the fast tier drops entries past its ttl and the slow tier then
+        # serves them for as long as its ttl allows
+        return self.fast.is_fresh(entry) or self.slow.is_fresh(entry)
+
+    def _load(self, key):
+        entry = self.fast.get(key)
+        if entry is None:
+            entry = self.slow.get(key)
+            if entry is not None:
+                self.fast.set(key, entry)
+        return entry
+
+    def _store(self, key, entry):
+        self.fast.set(key, entry)
+        self.slow.set(key, entry)
+
+    def _evict(self, key):
+        self.fast._evict(key)
+        self.slow._evict(key)
+
+
+def _lookup(cache, url, params):
+    """Returns the cache key, the cached body if it can be served as is, and the headers of the request to make
+    otherwise."""
+    key = url + "?" + "&".join("{}={}".format(k, params[k]) for k in sorted(params))
+    entry = cache.get(key)
+    headers = {}
+    if entry is not None:
+        if cache.is_fresh(entry):
+            cache.stats["hits"] += 1
+            return key, entry, entry.text, headers
+        if entry.etag:
+            headers["If-None-Match"] = entry.etag
+        if entry.last_modified:
+            headers["If-Modified-Since"] = entry.last_modified
+    return key, entry, None, headers
+
+
+def _store(cache, key, entry, response):
+    if entry is not None and response.status_code == 304:
+        cache.stats["revalidated"] += 1
+        cache.set(key, entry._replace(timestamp=time.time()))
+        return entry.text
+    # Failures are never cached; raises requests.HTTPError (or httpx.HTTPStatusError for async fetchers)
+    response.raise_for_status()
+    cache.set(key, CachedResponse(response.text, response.headers.get("ETag"), response.headers.get("Last-Modified"),
+                                  time.time()))
+    return response.text
+
+
+def cached_get(session, cache, url, params=None, timeout=None):
+    """Performs a GET through the cache, returning the response body.  Fresh entries are served without touching the
+    network; stale entries carrying an ETag or Last-Modified header are revalidated with a conditional request.
+    timeout overrides the session's own."""
+    params = params or {}
+    key, entry, text, headers = _lookup(cache, url, params)
+    if text is not None:
+        return text
+    options = {"timeout": timeout} if timeout is not None else {}
+    return _store(cache, key, entry, session.get(url, params=params, headers=headers, **options))
+
+
+async def cached_get_async(fetcher, cache, url, params=None):
+    """cached_get for a fetch.AsyncFetcher."""
+    params = params or {}
+    key, entry, text, headers = _lookup(cache, url, params)
+    if text is not None:
+        return text
+    return _store(cache, key, entry, await fetcher.get(url, params=params, headers=headers))
@@ -1,9 +1,15 @@
+import json
 from itertools import groupby
-from flask import Blueprint, request, jsonify, abort
+from flask import Blueprint, Response, request, jsonify, abort, stream_with_context
+from sqlalchemy.dialects import postgresql
 
 from . import search
 from . import models
+from . import archive
 from . import extractors
+from . import jobs
+from . import matching
+from . import nutrition
 
 recipe_search = Blueprint('recipe_search', __name__)
 
@@ -30,6 +36,23 @@ def food_com():
     return jsonify(results=results, next_page=fc_search.current_page)
 
 
+@recipe_search.route('/all/')
+def all_sites():
+    search_term = request.args.get("search")
+    try:
+        page = int(request.args.get("page", 1))
+        deadline = float(request.args.get("deadline", 5))
+    except ValueError:
+        return abort(400)
+    results, providers = search.federated_search(search_term, page, deadline)
+    return jsonify(results=results, providers=providers, next_page=page + 1)
+
+
+@recipe_search.route('/cache_stats/')
+def cache_stats():
+    return jsonify(stats=search.BaseSearch.response_cache.stats)
+
+
 @recipe_search.route('/retrieve/', methods=["POST"])
 def retrieve():
     targeted_results = request.get_json()
@@ -39,41 +62,190 @@ def retrieve():
     in_targeted_urls = url_column.in_(targeted_urls)
     select = models.db.select([url_column]).where(in_targeted_urls)
     present_urls = set(e[0] for e in models.db.engine.execute(select).fetchall())
-    recipe_documents = [extractors.HTMLExtractor.from_url(url) for url in targeted_urls if url not in present_urls]
+    # Repeats are removed, or the second document for a url would fail the whole batch on the unique constraint
+    missing_urls = [url for url in dict.fromkeys(targeted_urls) if url not in present_urls]
+    results = extractors.HTMLExtractor.from_urls(missing_urls)
+    recipe_documents = [result.value for result in results if not result.error]
+    failures = [{"url": result.url, "error": str(result.error)} for result in results if result.error]
     models.db.session.add_all(recipe_documents)
     models.db.session.commit()
-    return jsonify(recipe_documents=[document.as_dict for document in recipe_documents])
+    return jsonify(recipe_documents=[document.as_dict for document in recipe_documents], failures=failures)
+
+
+@recipe_search.route('/retrieve/jobs/', methods=["POST"])
+def create_retrieval_job():
+    """Retrieves the documents in the background, returning the id of a job that can be polled for progress."""
+    targeted_urls = [r.get("url") for r in request.get_json()]
+    job = jobs.create_job(targeted_urls)
+    return jsonify(retrieval_job_id=job.retrieval_job_id), 202
+
+
+@recipe_search.route('/retrieve/jobs/<int:job_id>/')
+def get_retrieval_job(job_id):
+    job = models.RetrievalJob.query.get(job_id)
+    if job is None:
+        return abort(404)
+    return jsonify(job=job.as_dict)
 
 
 @crud.route('/recipe_document/')
 def list_recipe_documents():
-    documents = models.RecipeDocument.query.all()
-    return jsonify(documents=[document.as_dict for document in documents])
+    """Lists documents a page at a time, ordered by id.  Pass the returned next_after back as after to get the next
+    page; html is only included if it is named in fields."""
+    after = request.args.get("after", 0, type=int)
+    limit = max(1, min(request.args.get("limit", 100, type=int), 1000))
+    fields = request.args.get("fields", "recipe_document_id,title,url").split(",")
+    if not set(fields) <= set(models.RecipeDocument.dict_fields):
+        return abort(400)
+    if "recipe_document_id" not in fields:
+        fields.insert(0, "recipe_document_id")
+    # html is kept in the archive, so only its key is loaded and the pages of all the documents are read together
+    columns = ["html_sha256" if field == "html" else field for field in fields]
+    documents = models.RecipeDocument.query\
+        .options(models.db.load_only(*columns))\
+        .filter(models.RecipeDocument.recipe_document_id > after)\
+        .order_by(models.RecipeDocument.recipe_document_id)\
+        .limit(limit)\
+        .all()
+    next_after = documents[-1].recipe_document_id if documents and len(documents) == limit else None
+    dicts = [document.as_partial_dict([field for field in fields if field != "html"]) for document in documents]
+    if "html" in fields:
+        pages = archive.storage.read_many([document.html_sha256 for document in documents if document.html_sha256])
+        for (document, document_dict) in zip(documents, dicts):
+            page = pages.get(document.html_sha256)
+            document_dict["html"] = page.decode("utf-8") if page is not None else None
+    return jsonify(documents=dicts, next_after=next_after)
 
 
 @crud.route('/recipe_document/<int:document_id>/')
 def get_recipe_document(document_id):
-    document = models.RecipeDocument.query.filter(models.RecipeDocument.recipe_document_id == document_id).first()
+    document = models.RecipeDocument.query.get(document_id)
+    if document is None:
+        return abort(404)
     return jsonify(document=document.as_dict)
 
 
+@crud.route('/recipe_document/<int:document_id>/raw/')
+def get_recipe_document_raw_html(document_id):
+    """The page the document was extracted from, streamed from the archive as it is decompressed."""
+    document = models.RecipeDocument.query.options(models.db.load_only("raw_html_sha256")).get(document_id)
+    if document is None or document.raw_html_sha256 is None:
+        return abort(404)
+    try:
+        page = archive.storage.open(document.raw_html_sha256)
+    except KeyError:
+        return abort(404)
+
+    def generate():
+        with page:
+            for chunk in iter(lambda: page.read(65536), b""):
+                yield chunk
+    return Response(generate(), mimetype="text/html")
+
+
+def rows_response(key, select):
+    """Serializes the rows of a core select under key.  ?stream=1 writes the JSON a batch of rows at a time from a
+    server side cursor instead of building it in memory, and ?layout=columnar returns one array per column instead
+    of an object per row."""
+    columns = [column.name for column in select.inner_columns]
+    if request.args.get("layout") == "columnar":
+        rows = models.db.session.execute(select).fetchall()
+        values = zip(*rows) if rows else [() for column in columns]
+        return jsonify(**{key: {column: list(column_values) for (column, column_values) in zip(columns, values)}})
+    if not request.args.get("stream"):
+        rows = models.db.session.execute(select).fetchall()
+        return jsonify(**{key: [dict(zip(columns, row)) for row in rows]})
+
+    def generate():
+        result = models.db.session.connection().execution_options(stream_results=True).execute(select)
+        yield '{"%s": [' % key
+        separator = ""
+        while True:
+            rows = result.fetchmany(1000)
+            if not rows:
+                break
+            yield separator + ",".join(json.dumps(dict(zip(columns, row))) for row in rows)
+            separator = ","
+        yield "]}"
+    return Response(stream_with_context(generate()), mimetype="application/json")
+
+
 @crud.route('/recipe_document/<int:document_id>/words/')
 def get_recipe_document_words(document_id):
-    words = models.RecipeDocumentWord.query\
-        .filter(models.RecipeDocumentWord.recipe_document_id == document_id)\
-        .order_by(models.RecipeDocumentWord.document_position)\
-        .all()
-    return jsonify(words=[word.as_dict for word in words])
+    table = models.RecipeDocumentWord.__table__
+    select = models.db.select([table.c.recipe_document_word_id, table.c.word, table.c.document_position,
+                               table.c.element_position, table.c.element_tag, table.c.original_format])\
+        .where(table.c.recipe_document_id == document_id)\
+        .order_by(table.c.document_position)
+    return rows_response("words", select)
+
+
+@crud.route('/recipe/<int:recipe_id>/nutrition/')
+def get_recipe_nutrition(recipe_id):
+    recipe_nutrition = nutrition.get_recipe_nutrition(recipe_id)
+    if recipe_nutrition is None:
+        return abort(404)
+    return jsonify(nutrition=recipe_nutrition.as_dict)
+
+
+@crud.route('/recipe/by_nutrients/')
+def find_recipes_by_nutrients():
+    """Filters and ranks every recipe by its nutrient totals, e.g. ?max_307=500&sort=203&per=208 for recipes with at
+    most 500mg of sodium, ordered by protein per calorie."""
+    ranges = {}
+    for (argument, value) in request.args.items():
+        if argument.startswith(("min_", "max_")):
+            try:
+                nutrient_id = int(argument[4:])
+                value = float(value)
+            except ValueError:
+                return abort(400)
+            (minimum, maximum) = ranges.get(nutrient_id, (None, None))
+            if argument.startswith("min_"):
+                ranges[nutrient_id] = (value, maximum)
+            else:
+                ranges[nutrient_id] = (minimum, value)
+    sort = request.args.get("sort", type=int)
+    per = request.args.get("per", type=int)
+    limit = request.args.get("limit", 50, type=int)
+    if limit < 1:
+        return abort(400)
+    nutrient_ids = set(ranges) | set(nutrient_id for nutrient_id in (sort, per) if nutrient_id is not None)
+    if nutrient_ids:
+        known = models.Nutrient.query.filter(models.Nutrient.nutrient_id.in_(nutrient_ids)).count()
+        if known != len(nutrient_ids):
+            return abort(400)
+    matches = nutrition.recipe_catalog().query(ranges, sort, per, limit)
+    return jsonify(recipes=[{"recipe_id": recipe_id, "score": score} for (recipe_id, score) in matches])
 
 
 @crud.route('/recipe_document_word_tag/')
 def get_recipe_document_word_tags():
     document_id = request.args.get("recipe_document_id")
-    tags = models.RecipeDocumentWordTag.query\
-        .join(models.RecipeDocumentTagSet)\
-        .filter(models.RecipeDocumentTagSet.recipe_document_id == document_id)\
-        .all()
-    return jsonify(tags=[tag.as_dict for tag in tags])
+    tags = models.RecipeDocumentWordTag.__table__
+    tag_sets = models.RecipeDocumentTagSet.__table__
+    select = models.db.select([tags.c.recipe_document_word_tag_id, tags.c.recipe_document_word_id,
+                               tags.c.recipe_document_id, tags.c.tag])\
+        .select_from(tags.join(tag_sets))\
+        .where(tag_sets.c.recipe_document_id == document_id)
+    return rows_response("tags", select)
+
+
+def get_or_create_tag_set_id(document_id):
+    tag_sets = models.RecipeDocumentTagSet.__table__
+    if models.db.engine.dialect.name == "postgresql":
+        # The no-op update makes RETURNING produce the id whether or not the tag set already existed
+        insert = postgresql.insert(tag_sets).values(recipe_document_id=document_id)
+        insert = insert.on_conflict_do_update(index_elements=[tag_sets.c.recipe_document_id],
+                                              set_={"recipe_document_id": insert.excluded.recipe_document_id})
+        return models.db.session.execute(insert.returning(tag_sets.c.recipe_document_tagset_id)).scalar()
+    # Inserting first means a concurrent request creating the same tag set can't make this one fail
+    models.db.session.execute(models.db.text("INSERT INTO recipe_document_tag_set (recipe_document_id) "
+                                             "VALUES (:document_id) ON CONFLICT (recipe_document_id) DO NOTHING"),
+                              {"document_id": document_id})
+    select = models.db.select([tag_sets.c.recipe_document_tagset_id])\
+        .where(tag_sets.c.recipe_document_id == document_id)
+    return models.db.session.execute(select).scalar()
 
 
 @crud.route('/recipe_document_word_tag/', methods=["POST"])
@@ -81,29 +253,35 @@ def create_recipe_document_word_tags():
     tags_json = request.get_json()
     if not tags_json:
         return ""
-    # It is assumed that all words are from the same document, it might be a good idea to check and enforce this in
-    # the future.
-    document = models.RecipeDocument.query\
-        .join(models.RecipeDocumentWord)\
-        .filter(models.RecipeDocumentWord.recipe_document_word_id == tags_json[0]["recipe_document_word_id"])\
-        .first()
-    document_id = document.recipe_document_id
+    word_ids = set(tag_dict["recipe_document_word_id"] for tag_dict in tags_json)
+    words = models.RecipeDocumentWord.__table__
+    select = models.db.select([words.c.recipe_document_id, models.db.func.count()])\
+        .where(words.c.recipe_document_word_id.in_(word_ids))\
+        .group_by(words.c.recipe_document_id)
+    documents = models.db.session.execute(select).fetchall()
+    # Every word has to exist and belong to the same document
+    if len(documents) != 1 or documents[0][1] != len(word_ids):
+        return abort(400)
+    document_id = documents[0][0]
     # TODO: update tagset creation to be user specific (when we have users)
-    recipe_document_tag_set = models.RecipeDocumentTagSet.query\
-        .filter(models.RecipeDocumentTagSet.recipe_document_id == document_id)\
-        .first()
-    if not recipe_document_tag_set:
-        recipe_document_tag_set = models.RecipeDocumentTagSet(recipe_document_id=document_id)
-        models.db.session.add(recipe_document_tag_set)
-    for tag_dict in tags_json:
-        tag = models.RecipeDocumentWordTag(
-            tag_set=recipe_document_tag_set,
-            recipe_document_word_id=tag_dict["recipe_document_word_id"],
-            tag=tag_dict["tag"]
-        )
-        models.db.session.add(tag)
+    tag_set_id = get_or_create_tag_set_id(document_id)
+    tags = models.RecipeDocumentWordTag.__table__
+    rows = [{"recipe_document_tagset_id": tag_set_id, "recipe_document_id": document_id,
+             "recipe_document_word_id": tag_dict["recipe_document_word_id"], "tag": tag_dict["tag"]}
+            for tag_dict in tags_json]
+    columns = [tags.c.recipe_document_word_tag_id, tags.c.recipe_document_word_id, tags.c.recipe_document_id,
+               tags.c.tag]
+    if models.db.engine.dialect.name == "postgresql":
+        created = models.db.session.execute(tags.insert().values(rows).returning(*columns)).fetchall()
+    else:
+        # No RETURNING here, so each row is inserted on its own to get its id from the cursor
+        created = [(models.db.session.execute(tags.insert().values(row)).inserted_primary_key[0],
+                    row["recipe_document_word_id"], row["recipe_document_id"], row["tag"]) for row in rows]
+    models.RecipeDocumentTagSet.tags_changed()
     models.db.session.commit()
-    return jsonify(tags=[tag.as_dict for tag in recipe_document_tag_set.tags])
+    # The core insert bypasses the mapper events that would otherwise do this
+    models.RecipeDocumentTagSet.invalidate_groups(tag_set_id)
+    return jsonify(tags=[dict(zip([column.name for column in columns], row)) for row in created])
 
 
 @crud.route('/recipe_document_word_tag/', methods=["DELETE"])
@@ -138,31 +316,30 @@ def recipe_from_tag_set(tag_set_id):
     tag_set = models.RecipeDocumentTagSet.query\
         .filter(models.RecipeDocumentTagSet.recipe_document_tagset_id == tag_set_id)\
         .first()
+    if not tag_set:
+        return abort(404)
     recipe = {"ingredients": [], "directions": []}
     current_recipe_component = None
     current_ingredient = {}
+    # Ingredient names are matched all at once after the walk, rather than with a query per ingredient
+    ingredient_names = []
     # First we need to group words by their tags
     for element in tag_set.groups:
         for tag_group in element:
             if "title" in tag_group.tags:
-                recipe["title"] = " ".join(tag_group.words)
+                recipe["title"] = " ".join(word.word for word in tag_group.words)
             elif "ingredients-heading" in tag_group.tags:
-                current_recipe_component = " ".join(tag_group.words)
+                current_recipe_component = " ".join(word.word for word in tag_group.words)
             elif "ingredient-name" in tag_group.tags:
-                ingredient_name = " ".join(tag_group.words)
-                name_similarity = models.db.func.similarity(models.IngredientName.name, ingredient_name)
-                matching_ingredients = models.IngredientName.query\
-                    .filter(models.db.desc(name_similarity))\
-                    .limit(10)\
-                    .all()
+                ingredient_name = " ".join(word.word for word in tag_group.words)
                 current_ingredient["ingredient_name"] = ingredient_name
-                current_ingredient["matching_ingredients"] = [name.as_dict for name in matching_ingredients]
+                ingredient_names.append(ingredient_name)
             elif "ingredient-quantity" in tag_group.tags:
                 current_ingredient["quantity"] = tag_group.words[0].as_number
             elif "ingredient-units" in tag_group.tags:
-                current_ingredient["units"] = tag_group.words[0]
+                current_ingredient["units"] = tag_group.words[0].word
             elif "ingredient-preparation" in tag_group.tags:
-                current_ingredient["preparation"] = " ".join(tag_group.words)
+                current_ingredient["preparation"] = " ".join(word.word for word in tag_group.words)
             elif "directions" in tag_group.tags:
                 current_step = []
                 last_word = None
@@ -171,7 +348,7 @@ def recipe_from_tag_set(tag_set_id):
                     is_non_symbol_word = not word.original_format or word.word == "#"
                     if last_word and not last_word.word == '(' and is_non_symbol_word:
                         current_step.append(" ")
-                    recipe["directions"].append(word.original_format or word.word)
+                    current_step.append(word.original_format or word.word)
                     last_word = word
                     if word.word == '.':
                         recipe["directions"].append("".join(current_step))
@@ -183,5 +360,10 @@ def recipe_from_tag_set(tag_set_id):
             if current_recipe_component:
                 current_ingredient["component"] = current_recipe_component
             recipe["ingredients"].append(current_ingredient)
+            current_ingredient = {}
+    matches = dict(zip(ingredient_names, matching.ingredient_matcher.match_all(ingredient_names)))
+    for ingredient in recipe["ingredients"]:
+        if "ingredient_name" in ingredient:
+            ingredient["matching_ingredients"] = matches[ingredient["ingredient_name"]]
     return recipe
 
@@ -1,34 +1,87 @@
+import asyncio
 import requests
 import re
+import lxml.html
 from lxml.html.clean import Cleaner
 
 from . import models
+from . import fetch
+from . import instrumentation
 
 
 class ExtractorException(Exception):
-    pass
+    """Raised with the response of a page that couldn't be retrieved."""
+
+    def __str__(self):
+        response = self.args[0] if self.args else None
+        if hasattr(response, "status_code"):
+            return "HTTP {} for {}".format(response.status_code, response.url)
+        return super(ExtractorException, self).__str__()
 
 
 class HTMLExtractor(object):
 
     _multiple_whitespace_cleaner = re.compile(r"\s+")
-    _title_extractor = re.compile(r"<title>(.*)</title>", re.IGNORECASE)
+    # Cleaners are stateless once configured, so one is shared by every extraction
+    _cleaner = Cleaner(remove_unknown_tags=False, allow_tags=["ol", "ul", "li", "p", "h1", "h2", "h3", "h4", "h5", "h6"])
+
+    @classmethod
+    def _sanitize_tree(cls, tree):
+        """Cleans a parsed page in place."""
+        cls._cleaner(tree)
+        collapse = cls._multiple_whitespace_cleaner.sub
+        for element in tree.iter():
+            if element.text:
+                element.text = collapse(" ", element.text)
+            if element.tail:
+                element.tail = collapse(" ", element.tail)
+        return tree
 
     @classmethod
     def _sanitize_html(cls, input_html):
-        cleaner = Cleaner(remove_unknown_tags=False, allow_tags=["ol", "ul", "li", "p", "h1", "h2", "h3", "h4", "h5", "h6"])
-        cleaned_html = cleaner.clean_html(input_html)
-        return cls._multiple_whitespace_cleaner.sub(" ", cleaned_html)
+        tree = cls._sanitize_tree(lxml.html.fromstring(input_html))
+        return lxml.html.tostring(tree, encoding="unicode")
 
     @classmethod
-    def from_url(cls, url):
-        response = requests.get(url)
-        if not response.ok:
+    def extract(cls, html):
+        """Returns the title, sanitized html and words of a page, parsing it only once."""
+        with instrumentation.phase("sanitize"):
+            tree = lxml.html.fromstring(html)
+            # The title has to be read before cleaning, which strips the head of the page
+            title = tree.findtext(".//title")
+            cls._sanitize_tree(tree)
+            safe_html = lxml.html.tostring(tree, encoding="unicode")
+        with instrumentation.phase("tokenize"):
+            words = list(models.RecipeDocument.iter_tree_words(tree))
+        return title, safe_html, words
+
+    @classmethod
+    def from_response(cls, url, response):
+        # Rather than response.ok, which httpx responses don't have
+        if response.status_code >= 400:
             raise ExtractorException(response)
-        else:
-            html = response.text
-            title_search = cls._title_extractor.search(html)
-            if title_search:
-                title = title_search.group(1)
-            safe_html = cls._sanitize_html(html)
-            return models.RecipeDocument(html=safe_html, url=url, title=title)
+        title, safe_html, words = cls.extract(response.text)
+        return models.RecipeDocument(raw_html=response.content, html=safe_html, url=url, title=title,
+                                     document_words=words)
+
+    @classmethod
+    def from_url(cls, url, fetcher=None):
+        response = fetcher.get(url) if fetcher else requests.get(url)
+        return cls.from_response(url, response)
+
+    @classmethod
+    def from_urls(cls, urls, fetcher=None):
+        """Retrieves documents for several urls concurrently, returning a FetchResult per url in input order."""
+        fetcher = fetcher or fetch.shared_fetcher
+        return fetcher.map(lambda url: cls.from_url(url, fetcher), urls)
+
+    @classmethod
+    async def from_url_async(cls, url, fetcher=None):
+        response = await (fetcher or fetch.shared_async_fetcher).get(url)
+        # Parsing and tokenizing are CPU bound, so they run on a worker thread to keep the event loop responsive
+        return await asyncio.get_running_loop().run_in_executor(None, cls.from_response, url, response)
+
+    @classmethod
+    async def from_urls_async(cls, urls, fetcher=None):
+        fetcher = fetcher or fetch.shared_async_fetcher
+        return await fetcher.map(lambda url: cls.from_url_async(url, fetcher), urls)
@@ -0,0 +1,114 @@
+import asyncio
+import contextvars
+import threading
+from collections import defaultdict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+import httpx
+import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+
+from . import instrumentation
+
+
+FetchResult = namedtuple("FetchResult", ["url", "value", "error"])
+
+
+def create_session(pool_size=10, retries=3, backoff_factor=0.3):
+    """Creates a requests session with a shared connection pool and automatic retries of transient failures."""
+    session = requests.Session()
+    retry = Retry(total=retries, backoff_factor=backoff_factor, status_forcelist=(500, 502, 503, 504))
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+class ConcurrentFetcher(object):
+    """Fetches many urls at once over a pooled session, without hammering any single host."""
+
+    def __init__(self, session=None, max_workers=10, per_host=4, timeout=10):
+        self.session = session or create_session(pool_size=max_workers)
+        self.max_workers = max_workers
+        self.per_host = per_host
+        self.timeout = timeout
+        self._host_semaphores = defaultdict(lambda: threading.BoundedSemaphore(self.per_host))
+        self._lock = threading.Lock()
+
+    def _host_semaphore(self, url):
+        with self._lock:
+            return self._host_semaphores[urlsplit(url).netloc]
+
+    def get(self, url, **kwargs):
+        kwargs.setdefault("timeout", self.timeout)
+        with self._host_semaphore(url), instrumentation.outbound(url):
+            return self.session.get(url, **kwargs)
+
+    def _apply(self, function, url):
+        try:
+            return FetchResult(url, function(url), None)
+        except Exception as e:
+            return FetchResult(url, None, e)
+
+    def map(self, function, urls):
+        """Calls function(url) for every url concurrently.  Results are returned in input order, and a failure is
+        recorded on its own FetchResult rather than raised, so one bad url does not sink the whole batch."""
+        urls = list(urls)
+        if not urls:
+            return []
+        # Each url runs in a copy of the caller's context, so per-request state such as instrumentation follows it
+        contexts = [contextvars.copy_context() for url in urls]
+        with ThreadPoolExecutor(max_workers=min(self.max_workers, len(urls))) as executor:
+            return list(executor.map(lambda context, url: context.run(self._apply, function, url), contexts, urls))
+
+
+class AsyncFetcher(object):
+    """The asyncio counterpart of ConcurrentFetcher, for the ASGI serving mode.  Every fetch is a coroutine on one
+    httpx connection pool, so hundreds can be in flight at once without a thread each."""
+
+    def __init__(self, max_connections=200, per_host=8, timeout=10, retries=3):
+        self.max_connections = max_connections
+        self.per_host = per_host
+        self.timeout = timeout
+        self.retries = retries
+        self._client = None
+        self._host_semaphores = defaultdict(lambda: asyncio.Semaphore(self.per_host))
+
+    @property
+    def client(self):
+        if self._client is None:
+            limits = httpx.Limits(max_connections=self.max_connections, max_keepalive_connections=self.max_connections)
+            # httpx only retries failed connection attempts, rather than 5xx responses as create_session does
+            transport = httpx.AsyncHTTPTransport(limits=limits, retries=self.retries)
+            self._client = httpx.AsyncClient(transport=transport, timeout=self.timeout, follow_redirects=True)
+        return self._client
+
+    async def get(self, url, **kwargs):
+        async with self._host_semaphores[urlsplit(url).netloc]:
+            with instrumentation.outbound(url):
+                return await self.client.get(url, **kwargs)
+
+    async def _apply(self, function, url):
+        try:
+            return FetchResult(url, await function(url), None)
+        except Exception as e:
+            return FetchResult(url, None, e)
+
+    async def map(self, function, urls):
+        """Awaits function(url), a coroutine function, for every url concurrently, with the same results as
+        ConcurrentFetcher.map."""
+        return list(await asyncio.gather(*(self._apply(function, url) for url in urls)))
+
+    async def aclose(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+        # Semaphores belong to the event loop they were first used on
+        self._host_semaphores.clear()
+
+
+# Shared between requests so that connections to the recipe sites stay warm
+shared_fetcher = ConcurrentFetcher()
+shared_async_fetcher = AsyncFetcher()
@@ -0,0 +1,341 @@
+import contextvars
+import cProfile
+import os
+import threading
+import time
+from bisect import bisect_left
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+from urllib.parse import urlsplit
+
+from flask import Blueprint, Response, current_app, g, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+
+# Set by init_app; until then phase and outbound are no-ops, so instrumented code costs nothing when it is off
+enabled = False
+# Directory that ?profile=1 requests write their profiles to; profiling is refused when it isn't configured, or when
+# the app is neither in debug mode nor has PROFILE_ALLOWED set
+profile_path = None
+
+_duration_buckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+_statement_buckets = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+# name -> (type, help, buckets)
+_metric_descriptions = {
+    "metarecipe_requests_total": ("counter", "Requests handled, by endpoint and status code.", None),
+    "metarecipe_request_duration_seconds": ("histogram", "Wall time of requests, by endpoint.", _duration_buckets),
+    "metarecipe_request_phase_seconds_total": (
+        "counter", "Time spent in each phase of requests, by endpoint.  Outbound requests made concurrently are "
+                   "summed, so phases can add up to more than the request duration.", None),
+    "metarecipe_request_sql_statements": ("histogram", "SQL statements executed per request, by endpoint.",
+                                          _statement_buckets),
+    "metarecipe_sql_repeated_statements_total": (
+        "counter", "Executions of a statement that had already been executed in the same request (N+1 queries), "
+                   "by endpoint.", None),
+    "metarecipe_sql_duration_seconds": ("histogram", "Duration of SQL statements, by endpoint.", _duration_buckets),
+    "metarecipe_outbound_requests_total": ("counter", "Outbound HTTP requests, by host and outcome.", None),
+    "metarecipe_outbound_request_duration_seconds": ("histogram", "Duration of outbound HTTP requests, by host.",
+                                                     _duration_buckets),
+}
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join("{}=\"{}\"".format(name, _escape(value)) for (name, value) in labels) + "}"
+
+
+class Histogram(object):
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Metrics(object):
+    """Counters and histograms keyed by metric name and a tuple of (label, value) pairs, rendered in the Prometheus
+    text exposition format."""
+
+    def __init__(self):
+        self._counters = defaultdict(float)
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+    def increment(self, name, labels=(), value=1):
+        with self._lock:
+            self._counters[(name, labels)] += value
+
+    def observe(self, name, labels, value):
+        with self._lock:
+            histogram = self._histograms.get((name, labels))
+            if histogram is None:
+                histogram = self._histograms[(name, labels)] = Histogram(_metric_descriptions[name][2])
+            histogram.observe(value)
+
+    def render(self):
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted(self._histograms.items(), key=lambda item: item[0])
+            lines = []
+            described = set()
+
+            def describe(name):
+                if name not in described:
+                    described.add(name)
+                    (metric_type, help_text) = _metric_descriptions[name][:2]
+                    lines.append("# HELP {} {}".format(name, help_text))
+                    lines.append("# TYPE {} {}".format(name, metric_type))
+
+            for ((name, labels), value) in counters:
+                describe(name)
+                lines.append("{}{} {}".format(name, _format_labels(labels), repr(float(value))))
+            for ((name, labels), histogram) in histograms:
+                describe(name)
+                cumulative = 0
+                for (bound, count) in zip(histogram.buckets + ("+Inf",), histogram.counts):
+                    cumulative += count
+                    lines.append("{}_bucket{} {}".format(name, _format_labels(labels + (("le", bound),)), cumulative))
+                lines.append("{}_sum{} {}".format(name, _format_labels(labels), repr(histogram.sum)))
+                lines.append("{}_count{} {}".format(name, _format_labels(labels), histogram.count))
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics()
+
+
+class RequestTimings(object):
+    """What one request spent its time on.  Shared with the threads doing work for the request, hence the lock."""
+
+    def __init__(self, endpoint):
+        self.endpoint = endpoint
+        self.start = time.perf_counter()
+        self.status = None
+        self.phases = defaultdict(float)
+        self.statements = Counter()
+        self._lock = threading.Lock()
+
+    def add(self, phase, seconds):
+        with self._lock:
+            self.phases[phase] += seconds
+
+    def add_statement(self, statement, seconds):
+        with self._lock:
+            self.phases["sql"] += seconds
+            self.statements[statement] += 1
+
+
+# Context variables are copied into the worker threads of fetch.ConcurrentFetcher and the federated search, so that
+# work done on behalf of a request is attributed to it
+_current_request = contextvars.ContextVar("metarecipe_current_request", default=None)
+
+
+@contextmanager
+def phase(name):
+    """Attributes the time spent in the block to a phase of the current request."""
+    timings = _current_request.get()
+    if timings is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings.add(name, time.perf_counter() - start)
+
+
+@contextmanager
+def outbound(url):
+    """Times an outbound HTTP request."""
+    if not enabled:
+        yield
+        return
+    start = time.perf_counter()
+    outcome = "error"
+    try:
+        yield
+        outcome = "ok"
+    finally:
+        elapsed = time.perf_counter() - start
+        host = urlsplit(url).netloc
+        metrics.observe("metarecipe_outbound_request_duration_seconds", (("host", host),), elapsed)
+        metrics.increment("metarecipe_outbound_requests_total", (("host", host), ("outcome", outcome)))
+        timings = _current_request.get()
+        if timings is not None:
+            timings.add("http", elapsed)
+
+
+def _time_serialization(app):
+    """Attributes the time spent serializing JSON responses to the serialize phase, through the app's JSON provider
+    (Flask 2.2 and later) or else its JSON encoder."""
+    provider = getattr(app, "json", None)
+    if provider is not None:
+        dumps = provider.dumps
+
+        def timed_dumps(obj, **kwargs):
+            with phase("serialize"):
+                return dumps(obj, **kwargs)
+
+        provider.dumps = timed_dumps
+        return
+
+    class TimedJSONEncoder(app.json_encoder):
+
+        def encode(self, o):
+            with phase("serialize"):
+                return super(TimedJSONEncoder, self).encode(o)
+
+    app.json_encoder = TimedJSONEncoder
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("metarecipe_statement_starts", []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info["metarecipe_statement_starts"].pop()
+    timings = _current_request.get()
+    metrics.observe("metarecipe_sql_duration_seconds", (("endpoint", timings.endpoint if timings else ""),), elapsed)
+    if timings is not None:
+        timings.add_statement(statement, elapsed)
+
+
+def _handle_error(exception_context):
+    starts = exception_context.connection.info.get("metarecipe_statement_starts") \
+        if exception_context.connection is not None else None
+    if starts:
+        starts.pop()
+
+
+def _start_profiler(kind):
+    if kind == "pyinstrument":
+        try:
+            import pyinstrument
+        except ImportError:
+            pass
+        else:
+            profiler = pyinstrument.Profiler()
+            profiler.start()
+            return profiler
+    profiler = cProfile.Profile()
+    profiler.enable()
+    return profiler
+
+
+def _dump_profile(profiler, endpoint):
+    name = "{}-{:.6f}".format(endpoint, time.time())
+    if isinstance(profiler, cProfile.Profile):
+        profiler.disable()
+        profiler.dump_stats(os.path.join(profile_path, name + ".prof"))
+    else:
+        profiler.stop()
+        with open(os.path.join(profile_path, name + ".html"), "w") as f:
+            f.write(profiler.output_html())
+
+
+def _profiling_allowed():
+    # Anyone who can reach the app could otherwise make it profile their requests
+    return current_app.debug or current_app.config.get("PROFILE_ALLOWED", False)
+
+
+def _start_request():
+    timings = RequestTimings(request.endpoint or "")
+    g.metarecipe_timings_token = _current_request.set(timings)
+    if profile_path and request.args.get("profile") and _profiling_allowed():
+        g.metarecipe_profiler = _start_profiler(request.args["profile"])
+
+
+def server_timing(timings):
+    """The Server-Timing header value listing the phases of a request so far."""
+    return ", ".join("{};dur={:.2f}".format(name, seconds * 1000) for (name, seconds) in sorted(timings.phases.items()))
+
+
+def _record_status(response):
+    timings = _current_request.get()
+    if timings is not None:
+        timings.status = response.status_code
+        # Streamed responses are still being produced, so only the phases so far are known
+        response.headers["Server-Timing"] = server_timing(timings)
+    return response
+
+
+def _record_request(timings, status):
+    endpoint = (("endpoint", timings.endpoint),)
+    metrics.increment("metarecipe_requests_total", endpoint + (("status", status),))
+    metrics.observe("metarecipe_request_duration_seconds", endpoint, time.perf_counter() - timings.start)
+    for (name, seconds) in timings.phases.items():
+        metrics.increment("metarecipe_request_phase_seconds_total", endpoint + (("phase", name),), seconds)
+    metrics.observe("metarecipe_request_sql_statements", endpoint, sum(timings.statements.values()))
+    repeated = sum(count - 1 for count in timings.statements.values())
+    if repeated:
+        metrics.increment("metarecipe_sql_repeated_statements_total", endpoint, repeated)
+
+
+def _finish_request(exception):
+    # Runs after a streamed response has been fully sent, so its work is included
+    timings = _current_request.get()
+    if timings is None:
+        return
+    profiler = g.pop("metarecipe_profiler", None)
+    if profiler is not None:
+        _dump_profile(profiler, timings.endpoint)
+    _record_request(timings, timings.status if exception is None else 500)
+    token = g.pop("metarecipe_timings_token", None)
+    if token is not None:
+        _current_request.reset(token)
+
+
+@contextmanager
+def timed_request(endpoint):
+    """Times a request served outside of Flask (see asgi.py) the way init_app's hooks time Flask routes.  Yields the
+    request's RequestTimings, or None when instrumentation is off; the caller sets its status, and the request counts
+    as a 500 if it doesn't."""
+    if not enabled:
+        yield None
+        return
+    timings = RequestTimings(endpoint)
+    token = _current_request.set(timings)
+    try:
+        yield timings
+    finally:
+        _record_request(timings, timings.status or 500)
+        _current_request.reset(token)
+
+
+metrics_blueprint = Blueprint('metrics', __name__)
+
+
+@metrics_blueprint.route('/metrics')
+def get_metrics():
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+
+def init_app(app):
+    """Turns instrumentation on for app.  PROFILE_PATH in the config enables ?profile=1 (cProfile) and
+    ?profile=pyinstrument on any endpoint, which write the request's profile to that directory, in debug mode or with
+    PROFILE_ALLOWED set."""
+    global enabled, profile_path
+    enabled = True
+    profile_path = app.config.get("PROFILE_PATH")
+    if profile_path:
+        os.makedirs(profile_path, exist_ok=True)
+    app.before_request(_start_request)
+    app.after_request(_record_status)
+    app.teardown_request(_finish_request)
+    _time_serialization(app)
+    app.register_blueprint(metrics_blueprint)
+    event.listen(Engine, "before_cursor_execute", _before_cursor_execute)
+    event.listen(Engine, "after_cursor_execute", _after_cursor_execute)
+    event.listen(Engine, "handle_error", _handle_error)
@@ -0,0 +1,160 @@
+"""Background retrieval of recipe documents.  create_job records the urls of a job and submits its id to the backend,
+and run_job retrieves them a batch at a time, recording the state of every url as its batch completes so that the
+job can be polled."""
+import datetime
+import logging
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import requests
+from sqlalchemy.exc import IntegrityError
+
+from . import extractors
+from . import fetch
+from . import models
+
+logger = logging.getLogger(__name__)
+
+# Runs the jobs: anything with a submit(function, *args) method, such as a concurrent.futures executor.  Only the job
+# id is submitted, so a backend can run jobs in other processes as long as they can import metarecipe.app.
+backend = ThreadPoolExecutor(max_workers=2, thread_name_prefix="retrieval-job")
+# Urls retrieved and committed together
+batch_size = 25
+# Attempts at a url that failed with a network error or a 429/5xx response before it is marked failed
+max_attempts = 3
+# Seconds before the first retry, doubling for each one after it
+retry_delay = 2.0
+
+_unfinished_states = ("queued", "retrying")
+
+
+def create_backend(workers=2, processes=False):
+    """Creates the in-process thread pool backend, or with processes a pool of worker processes, which keeps
+    extraction off the server's GIL."""
+    if processes:
+        # Forked workers would inherit the server's database connections, so they start afresh instead
+        return ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+    return ThreadPoolExecutor(max_workers=workers, thread_name_prefix="retrieval-job")
+
+
+def create_job(urls):
+    """Records a job for urls, repeats removed, and hands it to the backend."""
+    job = models.RetrievalJob(created_timestamp=datetime.datetime.now())
+    job.urls = [models.RetrievalJobUrl(position=position, url=url, state="queued", attempts=0)
+                for (position, url) in enumerate(dict.fromkeys(urls))]
+    models.db.session.add(job)
+    models.db.session.commit()
+    backend.submit(run_job, job.retrieval_job_id)
+    return job
+
+
+def _extract(url, fetcher):
+    response = fetcher.get(url)
+    if response.status_code >= 400:
+        raise extractors.ExtractorException(response)
+    return (response.content,) + extractors.HTMLExtractor.extract(response.text)
+
+
+def _retryable(error):
+    if isinstance(error, extractors.ExtractorException):
+        status_code = getattr(error.args[0], "status_code", None) if error.args else None
+        return status_code == 429 or (status_code or 0) >= 500
+    return isinstance(error, requests.RequestException)
+
+
+def _present_documents(urls):
+    """Returns the ids of the documents already retrieved for any of urls, by url."""
+    if not urls:
+        return {}
+    table = models.RecipeDocument.__table__
+    select = models.db.select([table.c.url, table.c.recipe_document_id]).where(table.c.url.in_(urls))
+    return dict(models.db.session.execute(select).fetchall())
+
+
+def _record_batch(job_urls, present, results):
+    # Another job may have stored some of the urls while these were being fetched
+    present = {**present, **_present_documents(list(results))}
+    retrieved = []
+    for job_url in job_urls:
+        if job_url.url in present:
+            job_url.state = "present"
+            job_url.recipe_document_id = present[job_url.url]
+            job_url.error = None
+            continue
+        result = results[job_url.url]
+        job_url.attempts += 1
+        if result.error:
+            job_url.error = str(result.error)
+            job_url.state = "retrying" if _retryable(result.error) and job_url.attempts < max_attempts else "failed"
+        else:
+            (raw_html, title, safe_html, words) = result.value
+            document = models.RecipeDocument(url=job_url.url, title=title, raw_html=raw_html, html=safe_html,
+                                             document_words=words)
+            retrieved.append((job_url, document))
+    models.db.session.add_all(document for (job_url, document) in retrieved)
+    models.db.session.flush()
+    for (job_url, document) in retrieved:
+        job_url.state = "retrieved"
+        job_url.recipe_document_id = document.recipe_document_id
+        job_url.error = None
+    models.db.session.commit()
+
+
+def _retrieve_batch(job_urls, fetcher):
+    present = _present_documents([job_url.url for job_url in job_urls])
+    missing = [job_url.url for job_url in job_urls if job_url.url not in present]
+    results = {result.url: result for result in fetcher.map(lambda url: _extract(url, fetcher), missing)}
+    try:
+        _record_batch(job_urls, present, results)
+    except IntegrityError:
+        # A document for one of the urls was committed after it was checked, so recording again marks it present
+        models.db.session.rollback()
+        _record_batch(job_urls, present, results)
+
+
+def _run_job(job_id, fetcher):
+    job = models.RetrievalJob.query.get(job_id)
+    job.started_timestamp = datetime.datetime.now()
+    models.db.session.commit()
+    for attempt in range(max_attempts):
+        # Every url in a batch is attempted once, so each round takes the urls that have been tried attempt times
+        unfinished = models.RetrievalJobUrl.query\
+            .filter(models.RetrievalJobUrl.retrieval_job_id == job_id)\
+            .filter(models.RetrievalJobUrl.state.in_(_unfinished_states))\
+            .filter(models.RetrievalJobUrl.attempts == attempt)\
+            .order_by(models.RetrievalJobUrl.position)\
+            .limit(batch_size)
+        job_urls = unfinished.all()
+        if job_urls and attempt:
+            time.sleep(retry_delay * 2 ** (attempt - 1))
+        while job_urls:
+            _retrieve_batch(job_urls, fetcher)
+            job_urls = unfinished.all()
+    job.finished_timestamp = datetime.datetime.now()
+    models.db.session.commit()
+
+
+def _abandon_job(job_id, error):
+    table = models.RetrievalJobUrl.__table__
+    models.db.session.execute(table.update()
+                              .where(table.c.retrieval_job_id == job_id)
+                              .where(table.c.state.in_(_unfinished_states))
+                              .values(state="failed", error=str(error)))
+    job = models.RetrievalJob.query.get(job_id)
+    job.finished_timestamp = datetime.datetime.now()
+    models.db.session.commit()
+
+
+def run_job(job_id, fetcher=None):
+    """Retrieves the urls of a job.  Runs on the backend, so it sets up its own app context."""
+    from .app import app
+    with app.app_context():
+        try:
+            _run_job(job_id, fetcher or fetch.shared_fetcher)
+        except Exception as e:
+            logger.exception("Retrieval job %s failed", job_id)
+            models.db.session.rollback()
+            _abandon_job(job_id, e)
+        finally:
+            models.db.session.remove()
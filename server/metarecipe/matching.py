@@ -0,0 +1,255 @@
+import json
+import os
+import re
+import threading
+from collections import OrderedDict, defaultdict
+import numpy
+from sqlalchemy import event
+from sqlalchemy.orm import Session, object_session
+
+from . import models
+from . import nutrition
+
+
+_non_word_re = re.compile(r"[^\w]+")
+
+
+def trigrams(text):
+    """Returns the set of trigrams of text, following pg_trgm: each word is lower cased and padded with two spaces in
+    front and one behind."""
+    result = set()
+    for word in _non_word_re.split(text.lower()):
+        if word:
+            padded = "  " + word + " "
+            result.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return result
+
+
+def trigram_similarity(a, b):
+    """Equivalent of pg_trgm's similarity(a, b)."""
+    a_trigrams = trigrams(a)
+    b_trigrams = trigrams(b)
+    shared = len(a_trigrams & b_trigrams)
+    return shared / (len(a_trigrams) + len(b_trigrams) - shared) if shared else 0.0
+
+
+class TrigramIndex(object):
+    """In-process fuzzy index over ingredient names.  Names are stored as trigram postings, and a query scores every
+    name sharing a trigram with it in one vectorized pass, using the same similarity as pg_trgm.
+
+    Postings loaded from a snapshot live in CSR arrays (optionally memory-mapped); names added afterwards go into
+    per-trigram overflow lists, so updates never rewrite the arrays."""
+
+    def __init__(self):
+        self.vocabulary = {}
+        self.names = []
+        self.ingredient_name_ids = []
+        self.ingredient_ids = []
+        self._lengths = []
+        self._lengths_array = None
+        self._offsets = numpy.zeros(1, dtype=numpy.int64)
+        self._postings = numpy.zeros(0, dtype=numpy.int32)
+        self._added_postings = defaultdict(list)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.names)
+
+    def add(self, ingredient_name_id, ingredient_id, name):
+        name_trigrams = trigrams(name or "")
+        with self._lock:
+            position = len(self.names)
+            for trigram in name_trigrams:
+                trigram_id = self.vocabulary.setdefault(trigram, len(self.vocabulary))
+                self._added_postings[trigram_id].append(position)
+            self.names.append(name)
+            self.ingredient_name_ids.append(ingredient_name_id)
+            self.ingredient_ids.append(ingredient_id)
+            self._lengths.append(len(name_trigrams))
+            self._lengths_array = None
+
+    def _trigram_postings(self, trigram_id):
+        if trigram_id + 1 < len(self._offsets):
+            yield self._postings[self._offsets[trigram_id]:self._offsets[trigram_id + 1]]
+        added = self._added_postings.get(trigram_id)
+        if added:
+            yield numpy.array(added, dtype=numpy.int32)
+
+    def query(self, name, limit=10):
+        """Returns the best matching names, most similar first, as (similarity, position) pairs."""
+        name_trigrams = trigrams(name)
+        with self._lock:
+            trigram_ids = [self.vocabulary[trigram] for trigram in name_trigrams if trigram in self.vocabulary]
+            postings = [p for trigram_id in trigram_ids for p in self._trigram_postings(trigram_id)]
+            if not postings:
+                return []
+            if self._lengths_array is None:
+                self._lengths_array = numpy.asarray(self._lengths, dtype=numpy.float32)
+            lengths = self._lengths_array
+            shared = numpy.bincount(numpy.concatenate(postings), minlength=len(lengths)).astype(numpy.float32)
+        candidates = numpy.flatnonzero(shared)
+        scores = shared[candidates] / (len(name_trigrams) + lengths[candidates] - shared[candidates])
+        if len(candidates) > limit:
+            best = numpy.argpartition(-scores, limit)[:limit]
+            candidates, scores = candidates[best], scores[best]
+        order = numpy.argsort(-scores, kind="stable")
+        return [(float(scores[i]), int(candidates[i])) for i in order]
+
+    def match(self, name, limit=10):
+        return [{"ingredient_name_id": self.ingredient_name_ids[position],
+                 "ingredient_id": self.ingredient_ids[position],
+                 "name": self.names[position]} for (score, position) in self.query(name, limit)]
+
+    @classmethod
+    def from_database(cls):
+        index = cls()
+        rows = models.db.session.query(models.IngredientName.ingredient_name_id,
+                                       models.IngredientName.ingredient_id,
+                                       models.IngredientName.name)
+        for row in rows:
+            index.add(*row)
+        return index
+
+    def save(self, path):
+        """Writes a snapshot to the directory path, compacting the postings into CSR arrays."""
+        os.makedirs(path, exist_ok=True)
+        with self._lock:
+            postings = [[] for trigram in self.vocabulary]
+            for trigram_id in range(len(self.vocabulary)):
+                for trigram_postings in self._trigram_postings(trigram_id):
+                    postings[trigram_id].extend(trigram_postings.tolist())
+            offsets = numpy.zeros(len(postings) + 1, dtype=numpy.int64)
+            offsets[1:] = numpy.cumsum([len(p) for p in postings])
+            flat = numpy.fromiter((position for p in postings for position in p), dtype=numpy.int32,
+                                  count=int(offsets[-1]))
+            numpy.save(os.path.join(path, "offsets.npy"), offsets)
+            numpy.save(os.path.join(path, "postings.npy"), flat)
+            numpy.save(os.path.join(path, "lengths.npy"), numpy.asarray(self._lengths, dtype=numpy.int32))
+            with open(os.path.join(path, "names.json"), "w") as f:
+                json.dump({"vocabulary": self.vocabulary, "names": self.names,
+                           "ingredient_name_ids": self.ingredient_name_ids, "ingredient_ids": self.ingredient_ids}, f)
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        index = cls()
+        mmap_mode = "r" if mmap else None
+        index._offsets = numpy.load(os.path.join(path, "offsets.npy"), mmap_mode=mmap_mode)
+        index._postings = numpy.load(os.path.join(path, "postings.npy"), mmap_mode=mmap_mode)
+        index._lengths = numpy.load(os.path.join(path, "lengths.npy")).tolist()
+        with open(os.path.join(path, "names.json")) as f:
+            data = json.load(f)
+        index.vocabulary = data["vocabulary"]
+        index.names = data["names"]
+        index.ingredient_name_ids = data["ingredient_name_ids"]
+        index.ingredient_ids = data["ingredient_ids"]
+        return index
+
+
+class IngredientMatcher(object):
+    """Resolves free text ingredient names to IngredientName rows.  When an in-process TrigramIndex is loaded it
+    answers every lookup; otherwise PostgreSQL uses the pg_trgm GiST index on ingredient_name.name, and other
+    databases (e.g. SQLite for local testing) get a TrigramIndex built from the ingredient_name table on first use."""
+
+    # One round trip for every name: each unnested name probes the index with % and takes its nearest neighbours
+    _batch_query = models.db.text(
+        "SELECT q.position, n.ingredient_name_id, n.ingredient_id, n.name "
+        "FROM unnest(:names) WITH ORDINALITY AS q(name, position) "
+        "CROSS JOIN LATERAL (SELECT ingredient_name_id, ingredient_id, name FROM ingredient_name "
+        "                    WHERE name % q.name ORDER BY name <-> q.name LIMIT :limit) AS n "
+        "ORDER BY q.position")
+
+    def __init__(self, limit=10, cache_size=2048, index=None):
+        self.limit = limit
+        self.index = index
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self._index_from_database = False
+        # The USDA data version (see nutrition.data_version_name) the index and cache reflect
+        self._data_version = None
+
+    def _cached(self, name):
+        with self._lock:
+            matches = self._cache.get(name)
+            if matches is not None:
+                self._cache.move_to_end(name)
+            return matches
+
+    def _remember(self, name, matches):
+        with self._lock:
+            self._cache[name] = matches
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+
+    def refresh(self):
+        """Forgets the cached matches, and the index too if it was built from the database, so that names written
+        without the ORM (e.g. by the USDA importer) are found.  An index loaded from a snapshot is kept."""
+        with self._lock:
+            if self._index_from_database:
+                self.index = None
+                self._index_from_database = False
+            self._cache.clear()
+
+    def _query_postgresql(self, names):
+        rows = models.db.session.execute(self._batch_query, {"names": names, "limit": self.limit})
+        matches = [[] for name in names]
+        for (position, ingredient_name_id, ingredient_id, name) in rows:
+            matches[position - 1].append({"ingredient_name_id": ingredient_name_id, "ingredient_id": ingredient_id,
+                                          "name": name})
+        return matches
+
+    def add_name(self, ingredient_name_id, ingredient_id, name):
+        if self.index is not None:
+            self.index.add(ingredient_name_id, ingredient_id, name)
+        # A new name can be a better match for names that are already cached
+        self.clear()
+
+    def match_all(self, names):
+        """Returns a list of the best matching ingredient names for each of names, looking up everything that isn't
+        already cached in a single query."""
+        version = models.DataVersion.get(nutrition.data_version_name)
+        if version != self._data_version:
+            self.refresh()
+            self._data_version = version
+        results = {name: self._cached(name) for name in names}
+        missing = [name for name in results if results[name] is None]
+        if missing:
+            if self.index is None and models.db.engine.dialect.name != "postgresql":
+                self.index = TrigramIndex.from_database()
+                self._index_from_database = True
+            if self.index is not None:
+                found = [self.index.match(name, self.limit) for name in missing]
+            else:
+                found = self._query_postgresql(missing)
+            for (name, matches) in zip(missing, found):
+                self._remember(name, matches)
+                results[name] = matches
+        return [results[name] for name in names]
+
+    def match(self, name):
+        return self.match_all([name])[0]
+
+
+ingredient_matcher = IngredientMatcher()
+
+
+@event.listens_for(models.IngredientName, "after_insert")
+def _queue_new_name(mapper, connection, target):
+    # Indexed once the insert commits, so names that are rolled back never become searchable
+    object_session(target).info.setdefault("metarecipe_new_ingredient_names", []).append(
+        (target.ingredient_name_id, target.ingredient_id, target.name))
+
+
+@event.listens_for(Session, "after_commit")
+def _index_new_names(session):
+    for row in session.info.pop("metarecipe_new_ingredient_names", ()):
+        ingredient_matcher.add_name(*row)
+
+
+@event.listens_for(Session, "after_rollback")
+def _forget_new_names(session):
+    session.info.pop("metarecipe_new_ingredient_names", None)
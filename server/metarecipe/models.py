@@ -1,10 +1,13 @@
 import datetime
 import re
+import threading
 from fractions import Fraction
 import lxml.html
-from collections import defaultdict, namedtuple
+from collections import Counter, OrderedDict, defaultdict, namedtuple
 from itertools import count, groupby
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session
 
 db = SQLAlchemy()
 
@@ -14,66 +17,146 @@ class RecipeDocument(db.Model):
     __tablename__ = "recipe_document"
     recipe_document_id = db.Column(db.Integer, primary_key=True)
     title = db.Column(db.Text)
-    html = db.Column(db.Unicode)
+    # Keys in the archive of the page as it was retrieved and of its sanitized html, see the html property
+    raw_html_sha256 = db.Column(db.String(64))
+    html_sha256 = db.Column(db.String(64))
     url = db.Column(db.Text, unique=True)
     retrieval_timestamp = db.Column(db.DateTime)
 
     recipe_id = db.Column(db.Integer, db.ForeignKey("recipe.recipe_id"))
     recipe = db.relationship("Recipe")
 
-    _all_word_re = re.compile(r"(\d+\.\d+|\d+\s*\d?\s*[/⁄]\s*\d+|\d+|[-'a-zA-Z]+|\s*[:°.()&]\s*)")
-    _number_re = re.compile(r"(\d+\.\d+|\d+\s*\d?\s*[/⁄]\s*\d+|\d+)")
-    _symbol_re = re.compile(r"(\s*[:°.()]\s*)")
+    # Every token is classified by the alternative that matched it, so each piece of text is scanned exactly once.
+    # Numbers are replaced with a "#" placeholder to improve model performance, and the space around symbols is
+    # retained to improve document rendering.
+    _token_re = re.compile(r"(?P<number>\d+\.\d+|\d+\s*\d?\s*[/⁄]\s*\d+|\d+)|(?P<word>[-'a-zA-Z]+)|"
+                           r"(?P<symbol>\s*[:°.()]\s*)|(?P<ampersand>\s*&\s*)")
 
-    _FormattedWord = namedtuple("FormattedWord", ["word", "original_formatting"])
+    # Column order of the tuples produced by iter_document_words
+    _word_columns = ("word", "document_position", "element_position", "element_tag", "original_format")
 
-    def __init__(self, **kwargs):
+    # Pages set on the document by key, kept so they are read back without going to the archive, and the keys of
+    # the ones that haven't been archived yet, which are stored when it is flushed
+    _pages = None
+    _unstored_pages = None
+
+    def __init__(self, document_words=None, raw_html=None, **kwargs):
         super().__init__(**kwargs)
+        if raw_html is not None:
+            self.raw_html_sha256 = self._set_page(raw_html)
         self.retrieval_timestamp = datetime.datetime.now()
-        self.words = self.get_document_words(self.html)
+        # Words are written in bulk once the document has an id (see _insert_pending_words) and only become ORM
+        # objects when document.words is read back.  Callers that tokenized elsewhere (e.g. in a worker process) can
+        # pass the iter_document_words tuples in directly.
+        if document_words is None:
+            document_words = self.iter_document_words(self.html)
+        self._pending_words = list(document_words)
+
+    def _set_page(self, page):
+        # archive stores its pages with ArchivedPage below, so it can't be imported before this module
+        from . import archive
+        data = page.encode("utf-8") if isinstance(page, str) else page
+        key = archive.page_key(data)
+        if self._pages is None:
+            self._pages = {}
+            self._unstored_pages = set()
+        self._pages[key] = data
+        self._unstored_pages.add(key)
+        return key
+
+    def _get_page(self, key):
+        from . import archive
+        if key is None:
+            return None
+        if self._pages and key in self._pages:
+            return self._pages[key]
+        try:
+            return archive.read(key)
+        except KeyError:
+            # A page missing from the archive reads as no page, as it does when documents are listed
+            return None
+
+    @property
+    def html(self):
+        """The sanitized page, read from the archive (see archive.py) rather than stored with the document."""
+        page = self._get_page(self.html_sha256)
+        return page.decode("utf-8") if page is not None else None
+
+    @html.setter
+    def html(self, html):
+        self.html_sha256 = self._set_page(html)
+
+    @property
+    def raw_html(self):
+        """The bytes of the page as it was retrieved."""
+        return self._get_page(self.raw_html_sha256)
 
     @classmethod
-    def _transform_word(cls, word_):
-        # Numbers are extracted and replaced with a index to improve model performance
-        if cls._number_re.match(word_):
-            return cls._FormattedWord("#", word_)
-        # The space around symbols is retained to improve document rendering
-        elif cls._symbol_re.match(word_):
-            return cls._FormattedWord(word_.strip(), word_)
-        else:
-            return cls._FormattedWord(word_.strip(), None)
+    def tokenize(cls, text):
+        """Yields a (word, original_format) pair for every token in text."""
+        if not text:
+            return
+        # findall hands back every match's groups in one call; exactly one group is non-empty, and words, the most
+        # common tokens, are tested first
+        for (number, word, symbol, ampersand) in cls._token_re.findall(text):
+            if word:
+                yield word, None
+            elif number:
+                yield "#", number
+            elif symbol:
+                yield symbol.strip(), symbol
+            else:
+                yield ampersand.strip(), None
 
     @classmethod
-    def _extract_words(cls, text):
-        return [word_ for word_ in cls._all_word_re.findall(text or '')]
+    def iter_document_words(cls, html):
+        return cls.iter_tree_words(lxml.html.fromstring(html))
 
     @classmethod
-    def get_document_words(cls, html):
-        results = []
-        document = lxml.html.fromstring(html)
-        elements = document.iter()
+    def iter_tree_words(cls, document):
+        """Yields a (word, document_position, element_position, element_tag, original_format) tuple per word of an
+        already parsed document."""
         document_position = count()
-        element_position = defaultdict(lambda: count())
-        for element in elements:
-            text_words = [cls._transform_word(word) for word in cls._extract_words(element.text)]
-            tail_words = [cls._transform_word(word) for word in cls._extract_words(element.tail)]
-            for (doc_pos, el_pos, transformed) in zip(document_position, element_position[element], text_words):
-                new_document = RecipeDocumentWord(
-                    word=transformed.word,
-                    document_position=doc_pos,
-                    element_position=el_pos,
-                    element_tag=element.tag,
-                    original_format=transformed.original_formatting)
-                results.append(new_document)
-            for (doc_pos, el_pos, transformed) in zip(document_position, element_position[element.getparent()], tail_words):
-                new_document = RecipeDocumentWord(
-                    word=transformed.word,
-                    document_position=doc_pos,
-                    element_position=el_pos,
-                    element_tag=element.getparent().tag,
-                    original_format=transformed.original_formatting)
-                results.append(new_document)
-        return results
+        element_position = defaultdict(count)
+        tokenize = cls.tokenize
+        for element in document.iter():
+            tag = element.tag
+            for (doc_pos, el_pos, (word, original_format)) in zip(document_position, element_position[element],
+                                                                   tokenize(element.text)):
+                yield (word, doc_pos, el_pos, tag, original_format)
+            parent = element.getparent()
+            for (doc_pos, el_pos, (word, original_format)) in zip(document_position, element_position[parent],
+                                                                   tokenize(element.tail)):
+                yield (word, doc_pos, el_pos, parent.tag, original_format)
+
+    @classmethod
+    def get_document_words(cls, html):
+        return [RecipeDocumentWord(**dict(zip(cls._word_columns, word))) for word in cls.iter_document_words(html)]
+
+    @classmethod
+    def insert_words(cls, connection, documents, chunk_size=5000):
+        """Writes the pending words of already flushed documents with multi-row executemany inserts.  The words stay
+        pending until the transaction commits (see _forget_written_words), so that a document flushed again after a
+        rollback is saved with them."""
+        insert = RecipeDocumentWord.__table__.insert()
+        rows = []
+        for document in documents:
+            words = getattr(document, "_pending_words", None)
+            if not words:
+                continue
+            document_id = document.recipe_document_id
+            for word in words:
+                row = dict(zip(cls._word_columns, word))
+                row["recipe_document_id"] = document_id
+                rows.append(row)
+                if len(rows) >= chunk_size:
+                    connection.execute(insert, rows)
+                    rows = []
+        if rows:
+            connection.execute(insert, rows)
+
+    # Fields that can be requested when listing documents
+    dict_fields = ("recipe_document_id", "title", "html", "url")
 
     @property
     def as_dict(self):
@@ -84,33 +167,121 @@ class RecipeDocument(db.Model):
             "url": self.url
         }
 
+    def as_partial_dict(self, fields):
+        return {field: getattr(self, field) for field in fields}
+
+
+@event.listens_for(Session, "after_flush")
+def _insert_pending_words(session, flush_context):
+    documents = [instance for instance in session.new if isinstance(instance, RecipeDocument)]
+    if documents:
+        RecipeDocument.insert_words(session.connection(), documents)
+        session.info.setdefault("metarecipe_documents_with_words", []).extend(documents)
+
+
+@event.listens_for(Session, "after_commit")
+def _forget_written_words(session):
+    for document in session.info.pop("metarecipe_documents_with_words", ()):
+        document._pending_words = None
+
+
+@event.listens_for(Session, "after_rollback")
+def _keep_unwritten_words(session):
+    session.info.pop("metarecipe_documents_with_words", None)
+
+
+TaggedWordGroup = namedtuple("TaggedWordGroup", ["tags", "words"])
+
+# RecipeDocumentTagSet.groups by tag set id, least recently used first, with the tags data version they were loaded at
+_groups_cache = OrderedDict()
+# The DataVersion bumped by every change to word tags, so that processes other than the writer's drop their groups
+tags_data_version_name = "recipe_document_word_tag"
+_groups_cache_size = 1024
+_groups_generation = 0
+_groups_lock = threading.Lock()
+
 
 class RecipeDocumentTagSet(db.Model):
     __tablename__ = "recipe_document_tag_set"
+    __table_args__ = (
+        db.UniqueConstraint("recipe_document_id"),
+    )
     recipe_document_tagset_id = db.Column(db.Integer, primary_key=True)
 
     recipe_document_id = db.Column(db.Integer, db.ForeignKey(RecipeDocument.recipe_document_id))
     recipe_document = db.relationship(RecipeDocument, backref="tag_sets")
 
+    @classmethod
+    def invalidate_groups(cls, tag_set_id=None):
+        """Forgets the memoized groups of a tag set, or of every tag set if tag_set_id is None."""
+        global _groups_generation
+        with _groups_lock:
+            _groups_generation += 1
+            if tag_set_id is None:
+                _groups_cache.clear()
+            else:
+                _groups_cache.pop(tag_set_id, None)
+
+    @classmethod
+    def tags_changed(cls, connection=None):
+        """Bumps the tags data version in the transaction changing the tags, which makes every process reload its
+        memoized groups once it commits."""
+        DataVersion.bump(tags_data_version_name, connection)
+
     @property
-    def grouped(self):
+    def groups(self):
+        """The tagged words of the document split by the element they appear in, with consecutive words that have the
+        same tags grouped together.  Memoized until the tags change."""
+        tag_set_id = self.recipe_document_tagset_id
+        # Read before the tags, so groups are never memoized under a version newer than them
+        version = DataVersion.get(tags_data_version_name)
+        with _groups_lock:
+            entry = _groups_cache.get(tag_set_id)
+            if entry is not None and entry[0] == version:
+                _groups_cache.move_to_end(tag_set_id)
+                return entry[1]
+            generation = _groups_generation
+        groups = self._load_groups()
+        with _groups_lock:
+            # Don't memoize groups that were loaded while the tags were being changed
+            if generation == _groups_generation:
+                _groups_cache[tag_set_id] = (version, groups)
+                while len(_groups_cache) > _groups_cache_size:
+                    _groups_cache.popitem(last=False)
+        return groups
+
+    def _load_groups(self):
+        words = RecipeDocumentWord.__table__
+        tags = RecipeDocumentWordTag.__table__
+        select = db.select([words, tags.c.tag])\
+            .select_from(words.join(tags))\
+            .where(tags.c.recipe_document_tagset_id == self.recipe_document_tagset_id)\
+            .order_by(words.c.document_position, words.c.recipe_document_word_id)
+        rows = db.session.execute(select)
         last_element_position = -1
         elements = [[]]
-        word_tags = defaultdict(lambda: set())
-        for tag in self.tags:
-            word_tags[tag.word].add(tag.tag)
-        for word in sorted(word_tags):
+        for (word_id, word_rows) in groupby(rows, lambda row: row[words.c.recipe_document_word_id]):
+            word_rows = list(word_rows)
+            # Detached from the session, so memoized words outlive the request that loaded them
+            word = RecipeDocumentWord(**{column.name: word_rows[0][column] for column in words.c})
+            word_tags = frozenset(row[tags.c.tag] for row in word_rows)
             if word.element_position <= last_element_position:
                 elements.append([])
-            elements[-1].append(word)
             last_element_position = word.element_position
-        TaggedWordGroup = namedtuple("TaggedWordGroup", ["tags", "words"])
-        return [[TaggedWordGroup(key, tuple(group)) for key, group in
-                 groupby(element, lambda word: frozenset(word_tags[word])) if key] for element in elements]
+            element = elements[-1]
+            if element and element[-1].tags == word_tags:
+                element[-1].words.append(word)
+            else:
+                element.append(TaggedWordGroup(word_tags, [word]))
+        return [[TaggedWordGroup(group.tags, tuple(group.words)) for group in element] for element in elements]
 
 
 class RecipeDocumentWord(db.Model):
     __tablename__ = "recipe_document_word"
+    __table_args__ = (
+        # A document's words are always read in order
+        db.Index("ix_recipe_document_word_document_position", "recipe_document_id", "document_position"),
+    )
     recipe_document_word_id = db.Column(db.Integer, primary_key=True)
     word = db.Column(db.Unicode)
     document_position = db.Column(db.Integer)
@@ -151,6 +322,12 @@ class RecipeDocumentWord(db.Model):
 
 class RecipeDocumentWordTag(db.Model):
     __tablename__ = "recipe_document_word_tag"
+    __table_args__ = (
+        # Tag sets are listed and grouped by joining their tags to the tagged words
+        db.Index("ix_recipe_document_word_tag_tagset_word", "recipe_document_tagset_id", "recipe_document_word_id"),
+        db.Index("ix_recipe_document_word_tag_word", "recipe_document_word_id"),
+        db.Index("ix_recipe_document_word_tag_document_tag", "recipe_document_id", "tag"),
+    )
     recipe_document_word_tag_id = db.Column(db.Integer, primary_key=True)
     tag = db.Column(db.Unicode)
 
@@ -160,6 +337,9 @@ class RecipeDocumentWordTag(db.Model):
     recipe_document_id = db.Column(db.Integer, db.ForeignKey(RecipeDocument.recipe_document_id))
     document = db.relationship(RecipeDocument, backref="tags")
 
+    recipe_document_tagset_id = db.Column(db.Integer, db.ForeignKey(RecipeDocumentTagSet.recipe_document_tagset_id))
+    tag_set = db.relationship(RecipeDocumentTagSet, backref="tags")
+
     @property
     def as_dict(self):
         return {
@@ -170,6 +350,26 @@ class RecipeDocumentWordTag(db.Model):
         }
 
 
+@event.listens_for(RecipeDocumentWordTag, "after_insert")
+@event.listens_for(RecipeDocumentWordTag, "after_update")
+@event.listens_for(RecipeDocumentWordTag, "after_delete")
+def _invalidate_tag_set_groups(mapper, connection, target):
+    tag_set_ids = set(inspect(target).attrs.recipe_document_tagset_id.history.deleted or ())
+    tag_set_ids.add(target.recipe_document_tagset_id)
+    for tag_set_id in tag_set_ids:
+        RecipeDocumentTagSet.invalidate_groups(tag_set_id)
+    RecipeDocumentTagSet.tags_changed(connection)
+
+
+@event.listens_for(Session, "after_bulk_update")
+@event.listens_for(Session, "after_bulk_delete")
+def _invalidate_bulk_tag_set_groups(context):
+    # Query.update and Query.delete don't say which tag sets they touched
+    if context.mapper.class_ is RecipeDocumentWordTag:
+        RecipeDocumentTagSet.invalidate_groups()
+        RecipeDocumentTagSet.tags_changed(context.session.connection())
+
+
 class Recipe(db.Model):
     __tablename__ = "recipe"
     recipe_id = db.Column(db.Integer, primary_key=True)
@@ -191,6 +391,11 @@ class Ingredient(db.Model):
 
 class IngredientName(db.Model):
     __tablename__ = "ingredient_name"
+    # Supports the % operator and <-> nearest neighbour ordering used by matching.IngredientMatcher
+    __table_args__ = (
+        db.Index("ix_ingredient_name_name_trgm", "name", postgresql_using="gist",
+                 postgresql_ops={"name": "gist_trgm_ops"}),
+    )
     ingredient_name_id = db.Column(db.Integer, primary_key=True)
     ingredient_id = db.Column(db.Integer, db.ForeignKey("ingredient.ingredient_id"))
     name = db.Column(db.Unicode)
@@ -207,10 +412,18 @@ class IngredientName(db.Model):
         }
 
 
+event.listen(IngredientName.__table__, "before_create",
+             db.DDL("CREATE EXTENSION IF NOT EXISTS pg_trgm").execute_if(dialect="postgresql"))
+
+
 class IngredientMeasure(db.Model):
     __tablename__ = "ingredient_preparation"
+    __table_args__ = (
+        db.UniqueConstraint("ingredient_id", "sequence"),
+    )
     ingredient_preparation_id = db.Column(db.Integer, primary_key=True)
     ingredient_id = db.Column(db.Integer, db.ForeignKey("ingredient.ingredient_id"))
+    sequence = db.Column(db.Integer)  # the USDA weight sequence number, which identifies a measure of an ingredient
     description = db.Column(db.Unicode)
     amount = db.Column(db.Float)
     weight = db.Column(db.Float)
@@ -230,6 +443,10 @@ class Nutrient(db.Model):
 
 class IngredientNutrient(db.Model):
     __tablename__ = "ingredient_nutrient"
+    __table_args__ = (
+        db.UniqueConstraint("ingredient_id", "nutrient_id"),
+        db.Index("ix_ingredient_nutrient_nutrient", "nutrient_id", "ingredient_id"),
+    )
     ingredient_nutrient_id = db.Column(db.Integer, primary_key=True)
     nutrient_id = db.Column(db.Integer, db.ForeignKey("nutrient.nutrient_id"))
     ingredient_id = db.Column(db.Integer, db.ForeignKey("ingredient.ingredient_id"))
@@ -238,6 +455,9 @@ class IngredientNutrient(db.Model):
 
 class RecipeIngredient(db.Model):
     __tablename__ = "recipe_ingredient"
+    __table_args__ = (
+        db.Index("ix_recipe_ingredient_recipe", "recipe_id"),
+    )
     recipe_ingredient_id = db.Column(db.Integer, primary_key=True)
 
     component = db.Column(db.Text)  # for recipes with multiple "parts"
@@ -247,10 +467,40 @@ class RecipeIngredient(db.Model):
     ingredient = db.relationship(Ingredient, backref="recipe_instances")
     ingredient_form = db.Column(db.Text)  # this might want to become its own entity
 
-    recipe_id = db.Column(db.Integer(), db.ForeignKey("recipe"))
+    recipe_id = db.Column(db.Integer, db.ForeignKey("recipe.recipe_id"))
     recipe = db.relationship(Recipe, backref="ingredients")
 
 
+class RecipeNutrition(db.Model):
+    """Precomputed nutrient totals of a recipe, removed whenever the recipe's ingredients change."""
+    __tablename__ = "recipe_nutrition"
+    recipe_id = db.Column(db.Integer, db.ForeignKey("recipe.recipe_id"), primary_key=True)
+    nutrients = db.Column(db.JSON)  # nutrient_id -> total quantity
+    unresolved_ingredients = db.Column(db.JSON)  # recipe_ingredient_ids that couldn't be converted to grams
+    computed_timestamp = db.Column(db.DateTime)
+
+    @property
+    def as_dict(self):
+        return {
+            "recipe_id": self.recipe_id,
+            "nutrients": self.nutrients,
+            "unresolved_ingredients": self.unresolved_ingredients
+        }
+
+
+@event.listens_for(RecipeIngredient, "after_insert")
+@event.listens_for(RecipeIngredient, "after_update")
+@event.listens_for(RecipeIngredient, "after_delete")
+def _invalidate_recipe_nutrition(mapper, connection, target):
+    # A recipe ingredient moved to another recipe changes the nutrition of both
+    recipe_ids = set(inspect(target).attrs.recipe_id.history.deleted or ())
+    recipe_ids.add(target.recipe_id)
+    recipe_ids.discard(None)
+    if recipe_ids:
+        table = RecipeNutrition.__table__
+        connection.execute(table.delete().where(table.c.recipe_id.in_(recipe_ids)))
+
+
 class RecipeStep(db.Model):
     __tablename__ = "recipe_step"
     recipe_step_id = db.Column(db.Integer, primary_key=True)
@@ -267,4 +517,88 @@ class RecipeStepGroup(db.Model):
     __tablename__ = "recipe_step_group"
     recipe_step_group_id = db.Column(db.Integer, primary_key=True)
 
-    title = db.Column(db.Text)
\ No newline at end of file
+    title = db.Column(db.Text)
+
+
+class RetrievalJob(db.Model):
+    """A batch of urls retrieved in the background by jobs.run_job."""
+    __tablename__ = "retrieval_job"
+    retrieval_job_id = db.Column(db.Integer, primary_key=True)
+    created_timestamp = db.Column(db.DateTime)
+    started_timestamp = db.Column(db.DateTime)
+    finished_timestamp = db.Column(db.DateTime)
+
+    urls = db.relationship("RetrievalJobUrl", order_by="RetrievalJobUrl.position")
+
+    @property
+    def state(self):
+        if self.finished_timestamp:
+            return "finished"
+        return "running" if self.started_timestamp else "queued"
+
+    @property
+    def as_dict(self):
+        return {
+            "retrieval_job_id": self.retrieval_job_id,
+            "state": self.state,
+            "created_timestamp": self.created_timestamp,
+            "finished_timestamp": self.finished_timestamp,
+            "states": Counter(job_url.state for job_url in self.urls),
+            "urls": [job_url.as_dict for job_url in self.urls]
+        }
+
+
+class RetrievalJobUrl(db.Model):
+    """The progress of one url of a RetrievalJob.  state is one of queued, retrying, retrieved, present (a document
+    already had the url) or failed."""
+    __tablename__ = "retrieval_job_url"
+    retrieval_job_id = db.Column(db.Integer, db.ForeignKey("retrieval_job.retrieval_job_id"), primary_key=True)
+    position = db.Column(db.Integer, primary_key=True)
+    url = db.Column(db.Text)
+    state = db.Column(db.Text)
+    attempts = db.Column(db.Integer)
+    error = db.Column(db.Text)
+
+    recipe_document_id = db.Column(db.Integer, db.ForeignKey("recipe_document.recipe_document_id"))
+
+    @property
+    def as_dict(self):
+        return {
+            "url": self.url,
+            "state": self.state,
+            "attempts": self.attempts,
+            "error": self.error,
+            "recipe_document_id": self.recipe_document_id
+        }
+
+
+class ArchivedPage(db.Model):
+    """A compressed page stored by archive.DatabaseArchive under the SHA-256 of its bytes."""
+    __tablename__ = "archived_page"
+    sha256 = db.Column(db.String(64), primary_key=True)
+    codec = db.Column(db.Text)
+    size = db.Column(db.Integer)
+    content = db.Column(db.LargeBinary)
+
+
+class DataVersion(db.Model):
+    """A counter per imported data set, bumped by its importer so that other processes caching the data can tell
+    that it changed."""
+    __tablename__ = "data_version"
+    name = db.Column(db.Text, primary_key=True)
+    version = db.Column(db.Integer)
+
+    @classmethod
+    def get(cls, name, connection=None):
+        table = cls.__table__
+        select = db.select([table.c.version]).where(table.c.name == name)
+        return (connection or db.session).execute(select).scalar() or 0
+
+    @classmethod
+    def bump(cls, name, connection=None):
+        """Increments the version in the current transaction, or that of connection (e.g. during a flush)."""
+        connection = connection or db.session
+        table = cls.__table__
+        updated = connection.execute(table.update().where(table.c.name == name).values(version=table.c.version + 1))
+        if not updated.rowcount:
+            connection.execute(table.insert().values(name=name, version=1))
@@ -0,0 +1,268 @@
+import datetime
+import os
+import threading
+import numpy
+from scipy import sparse
+from sqlalchemy import event
+
+from . import models
+from . import units
+
+
+class NutrientMatrix(object):
+    """Dense ingredient x nutrient matrix of IngredientNutrient.quantity, which USDA gives per 100 grams."""
+
+    def __init__(self, ingredient_ids, nutrient_ids, quantities, data_version=None):
+        self.ingredient_ids = ingredient_ids
+        self.nutrient_ids = nutrient_ids
+        self.quantities = quantities
+        # The DataVersion of the USDA data the matrix was read from, if known
+        self.data_version = data_version
+        self._ingredient_rows = {int(ingredient_id): row for (row, ingredient_id) in enumerate(ingredient_ids)}
+
+    @classmethod
+    def from_rows(cls, ingredient_ids, nutrient_ids, quantities):
+        """Builds the matrix from parallel (ingredient_id, nutrient_id, quantity) arrays."""
+        (unique_ingredient_ids, rows) = numpy.unique(numpy.asarray(ingredient_ids, dtype=numpy.int64),
+                                                     return_inverse=True)
+        (unique_nutrient_ids, columns) = numpy.unique(numpy.asarray(nutrient_ids, dtype=numpy.int64),
+                                                      return_inverse=True)
+        matrix = numpy.zeros((len(unique_ingredient_ids), len(unique_nutrient_ids)), dtype=numpy.float64)
+        matrix[rows, columns] = numpy.nan_to_num(numpy.asarray(quantities, dtype=numpy.float64))
+        return cls(unique_ingredient_ids, unique_nutrient_ids, matrix)
+
+    @classmethod
+    def from_database(cls):
+        # Read before the rows, so the matrix never claims a newer version than the data it holds
+        version = models.DataVersion.get(data_version_name)
+        table = models.IngredientNutrient.__table__
+        select = models.db.select([table.c.ingredient_id, table.c.nutrient_id, table.c.quantity])
+        rows = models.db.session.execute(select).fetchall()
+        if not rows:
+            matrix = cls.from_rows([], [], [])
+        else:
+            (ingredient_ids, nutrient_ids, quantities) = zip(*rows)
+            matrix = cls.from_rows(ingredient_ids, nutrient_ids, [numpy.nan if q is None else q for q in quantities])
+        matrix.data_version = version
+        return matrix
+
+    def save(self, path):
+        os.makedirs(path, exist_ok=True)
+        numpy.save(os.path.join(path, "ingredient_ids.npy"), self.ingredient_ids)
+        numpy.save(os.path.join(path, "nutrient_ids.npy"), self.nutrient_ids)
+        numpy.save(os.path.join(path, "quantities.npy"), self.quantities)
+        if self.data_version is not None:
+            numpy.save(os.path.join(path, "data_version.npy"), numpy.int64(self.data_version))
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        """Loads a snapshot written by save; the quantities are memory-mapped so worker processes share them."""
+        version_path = os.path.join(path, "data_version.npy")
+        return cls(numpy.load(os.path.join(path, "ingredient_ids.npy")),
+                   numpy.load(os.path.join(path, "nutrient_ids.npy")),
+                   numpy.load(os.path.join(path, "quantities.npy"), mmap_mode="r" if mmap else None),
+                   int(numpy.load(version_path)) if os.path.exists(version_path) else None)
+
+    def rows(self, ingredient_ids):
+        """Returns the matrix row of each ingredient, or -1 for ingredients without nutrient data."""
+        return numpy.fromiter((self._ingredient_rows.get(ingredient_id, -1) for ingredient_id in ingredient_ids),
+                              dtype=numpy.int64, count=len(ingredient_ids))
+
+    def totals(self, ingredient_ids, grams):
+        """Sums the nutrients of the given weights of ingredients in one matrix product."""
+        rows = self.rows(ingredient_ids)
+        known = rows >= 0
+        return (numpy.asarray(grams, dtype=numpy.float64)[known] / 100) @ self.quantities[rows[known]]
+
+
+class RecipeCatalog(object):
+    """Nutrient totals of every recipe, from a sparse recipe x ingredient matrix of grams multiplied by the
+    NutrientMatrix, so that nutrient profile queries over the whole catalog are a few vectorized operations."""
+
+    def __init__(self, recipe_ids, totals, nutrient_ids):
+        self.recipe_ids = recipe_ids
+        self.totals = totals
+        self.nutrient_ids = nutrient_ids
+
+    def _nutrient_totals(self, nutrient_id, rows=slice(None)):
+        columns = numpy.flatnonzero(self.nutrient_ids == nutrient_id)
+        if not len(columns):
+            # A nutrient no ingredient has data for yet totals zero in every recipe
+            return numpy.zeros(len(self.recipe_ids))[rows]
+        return self.totals[rows, int(columns[0])]
+
+    @classmethod
+    def from_database(cls, matrix):
+        recipe_ingredients = models.db.session.query(models.RecipeIngredient.recipe_id,
+                                                     models.RecipeIngredient.ingredient_id,
+                                                     models.RecipeIngredient.quantity,
+                                                     models.RecipeIngredient.units)\
+            .filter(models.RecipeIngredient.recipe_id.isnot(None))\
+            .all()
+        measures = {}
+        for measure in models.IngredientMeasure.query.order_by(models.IngredientMeasure.sequence):
+            measures.setdefault(measure.ingredient_id, []).append(measure)
+        recipe_ids = numpy.unique([ingredient.recipe_id for ingredient in recipe_ingredients]).astype(numpy.int64)
+        recipe_rows = {int(recipe_id): row for (row, recipe_id) in enumerate(recipe_ids)}
+        rows = []
+        columns = []
+        grams = []
+        ingredient_rows = matrix.rows([ingredient.ingredient_id for ingredient in recipe_ingredients])
+        for (ingredient, ingredient_row) in zip(recipe_ingredients, ingredient_rows):
+            weight = ingredient_grams(ingredient.quantity, ingredient.units, measures.get(ingredient.ingredient_id, []))
+            if weight is not None and ingredient_row >= 0:
+                rows.append(recipe_rows[ingredient.recipe_id])
+                columns.append(ingredient_row)
+                grams.append(weight / 100)
+        recipe_ingredient_matrix = sparse.csr_matrix((grams, (rows, columns)),
+                                                     shape=(len(recipe_ids), len(matrix.ingredient_ids)))
+        totals = numpy.asarray(recipe_ingredient_matrix @ numpy.asarray(matrix.quantities))
+        return cls(recipe_ids, totals, matrix.nutrient_ids)
+
+    def query(self, ranges=None, sort=None, per=None, limit=50):
+        """Returns (recipe_id, score) pairs of the recipes whose totals fall within ranges, a dict of nutrient_id to
+        (minimum, maximum) with None for an open end.  Recipes are ordered by the total of the sort nutrient,
+        divided by the total of the per nutrient if given, highest first."""
+        selected = numpy.ones(len(self.recipe_ids), dtype=bool)
+        for (nutrient_id, (minimum, maximum)) in (ranges or {}).items():
+            values = self._nutrient_totals(nutrient_id)
+            if minimum is not None:
+                selected &= values >= minimum
+            if maximum is not None:
+                selected &= values <= maximum
+        candidates = numpy.flatnonzero(selected)
+        if sort is None:
+            scores = numpy.zeros(len(candidates))
+        else:
+            scores = self._nutrient_totals(sort, candidates)
+            if per is not None:
+                denominators = self._nutrient_totals(per, candidates)
+                with numpy.errstate(divide="ignore", invalid="ignore"):
+                    scores = numpy.where(denominators > 0, scores / denominators, numpy.nan)
+                candidates, scores = candidates[~numpy.isnan(scores)], scores[~numpy.isnan(scores)]
+            if len(candidates) > limit:
+                best = numpy.argpartition(-scores, limit)[:limit]
+                candidates, scores = candidates[best], scores[best]
+            order = numpy.argsort(-scores, kind="stable")
+            candidates, scores = candidates[order], scores[order]
+        return [(int(self.recipe_ids[row]), float(score)) for (row, score) in zip(candidates[:limit], scores[:limit])]
+
+
+# The models.DataVersion bumped by the USDA importer, which usually runs in another process
+data_version_name = "usda_nutrition"
+
+_matrix = None
+_matrix_version = None
+_catalog = None
+_lock = threading.Lock()
+# A NutrientMatrix.save snapshot to memory-map instead of reading ingredient_nutrient, set from the app config
+matrix_path = None
+
+
+def _load_nutrient_matrix(version):
+    if matrix_path:
+        matrix = NutrientMatrix.load(matrix_path)
+        if matrix.data_version == version:
+            return matrix
+        # The snapshot predates the last import, so the data is read from the database until it is rebuilt
+    return NutrientMatrix.from_database()
+
+
+def nutrient_matrix():
+    """Returns the NutrientMatrix, loading it again (and dropping the catalog) once the USDA data has changed."""
+    global _matrix, _matrix_version, _catalog
+    version = models.DataVersion.get(data_version_name)
+    with _lock:
+        if _matrix is None or _matrix_version != version:
+            _matrix = _load_nutrient_matrix(version)
+            _matrix_version = version
+            _catalog = None
+        return _matrix
+
+
+def recipe_catalog():
+    global _catalog
+    matrix = nutrient_matrix()
+    with _lock:
+        if _catalog is None:
+            _catalog = RecipeCatalog.from_database(matrix)
+        return _catalog
+
+
+def reset_nutrient_matrix():
+    global _matrix, _matrix_version, _catalog
+    with _lock:
+        _matrix = None
+        _matrix_version = None
+        _catalog = None
+
+
+@event.listens_for(models.RecipeIngredient, "after_insert")
+@event.listens_for(models.RecipeIngredient, "after_update")
+@event.listens_for(models.RecipeIngredient, "after_delete")
+def _invalidate_recipe_catalog(mapper, connection, target):
+    global _catalog
+    with _lock:
+        _catalog = None
+
+
+def ingredient_grams(quantity, unit_name, measures):
+    """Converts a quantity of an ingredient to grams using its USDA measures, returning None when that isn't
+    possible."""
+    if quantity is None:
+        return None
+    if unit_name:
+        grams_per_unit = units.grams_per_unit(unit_name)
+        if grams_per_unit is not None:
+            return quantity * grams_per_unit
+        volume = units.to_cubic_meters(quantity, unit_name)
+        densities = [measure.density for measure in measures if measure.density]
+        if volume is not None and densities:
+            # Densities are in kilograms per cubic meter
+            return volume * float(numpy.median(densities)) * 1000
+    # Counted units such as "large" (or no units at all) are weighed using the matching measure, e.g. "1 large egg"
+    for measure in measures:
+        if measure.amount and (not unit_name or (measure.description or "").startswith(unit_name)):
+            return quantity * measure.weight / measure.amount
+    return None
+
+
+def compute_recipe_nutrition(recipe_id):
+    recipe_ingredients = models.RecipeIngredient.query\
+        .filter(models.RecipeIngredient.recipe_id == recipe_id)\
+        .all()
+    ingredient_ids = set(ingredient.ingredient_id for ingredient in recipe_ingredients)
+    measures = {}
+    if ingredient_ids:
+        for measure in models.IngredientMeasure.query\
+                .filter(models.IngredientMeasure.ingredient_id.in_(ingredient_ids))\
+                .order_by(models.IngredientMeasure.sequence):
+            measures.setdefault(measure.ingredient_id, []).append(measure)
+    resolved_ids = []
+    grams = []
+    unresolved = []
+    for ingredient in recipe_ingredients:
+        weight = ingredient_grams(ingredient.quantity, ingredient.units, measures.get(ingredient.ingredient_id, []))
+        if weight is None:
+            unresolved.append(ingredient.recipe_ingredient_id)
+        else:
+            resolved_ids.append(ingredient.ingredient_id)
+            grams.append(weight)
+    matrix = nutrient_matrix()
+    totals = matrix.totals(resolved_ids, grams)
+    nutrients = {str(nutrient_id): float(total) for (nutrient_id, total) in zip(matrix.nutrient_ids, totals) if total}
+    return models.RecipeNutrition(recipe_id=recipe_id, nutrients=nutrients, unresolved_ingredients=unresolved,
+                                  computed_timestamp=datetime.datetime.now())
+
+
+def get_recipe_nutrition(recipe_id):
+    """Returns the stored nutrition rollup of a recipe, computing and storing it first if it was invalidated, or None
+    if there is no such recipe."""
+    recipe_nutrition = models.RecipeNutrition.query.get(recipe_id)
+    if recipe_nutrition is None:
+        if models.Recipe.query.get(recipe_id) is None:
+            return None
+        recipe_nutrition = compute_recipe_nutrition(recipe_id)
+        models.db.session.merge(recipe_nutrition)
+        models.db.session.commit()
+    return recipe_nutrition
@@ -1,10 +1,19 @@
-from collections import namedtuple
+import contextvars
+import time
+from collections import namedtuple, deque
+from concurrent.futures import ThreadPoolExecutor, wait
+from itertools import chain
+import asyncio
+import httpx
 import requests
 import re
 import urllib
 import json
 from lxml import html
 
+from . import cache
+from . import fetch
+
 
 SearchResult = namedtuple("SearchResult", ["title", "author", "url", "result_id"])
 
@@ -14,16 +23,64 @@ class SearchRequestException(Exception):
 
 
 class BaseSearch(object):
-    def __init__(self, search_term, start_page=1):
+    # Shared by every search, so that paging back and forth does not hit the remote sites again.  The app swaps this
+    # for a TieredCache when an on-disk cache is configured.
+    response_cache = cache.MemoryCache()
+
+    def __init__(self, search_term, start_page=1, prefetch_pages=0):
         self.search_term = search_term
         self.current_page = int(start_page)
+        # The number of pages fetched in the background ahead of the page being consumed when iterating
+        self.prefetch_pages = prefetch_pages
 
     def get_next_results_page(self):
         results = self.get_results_page(self.current_page)
         self.current_page += 1
         return results
 
+    def _get(self, url, params, timeout=None):
+        try:
+            return cache.cached_get(fetch.shared_fetcher, self.response_cache, url, params, timeout)
+        except requests.HTTPError as e:
+            raise SearchRequestException(e.response)
+
+    async def _get_async(self, fetcher, url, params):
+        try:
+            return await cache.cached_get_async(fetcher, self.response_cache, url, params)
+        except httpx.HTTPStatusError as e:
+            raise SearchRequestException(e.response)
+
+    def get_results_page(self, page, timeout=None):
+        return self._parse_results_page(self._get(*self._page_request(page), timeout=timeout), page)
+
+    async def get_results_page_async(self, page, fetcher=None):
+        response_text = await self._get_async(fetcher or fetch.shared_async_fetcher, *self._page_request(page))
+        return self._parse_results_page(response_text, page)
+
+    def _iter_prefetched(self):
+        executor = ThreadPoolExecutor(max_workers=self.prefetch_pages)
+        pending = deque()
+        next_page = self.current_page
+        try:
+            while True:
+                while len(pending) <= self.prefetch_pages:
+                    pending.append(executor.submit(self.get_results_page, next_page))
+                    next_page += 1
+                current_page_results = pending.popleft().result()
+                self.current_page += 1
+                if not current_page_results:
+                    break
+                for result in current_page_results:
+                    yield result
+        finally:
+            # Runs when the results run out and also when the consumer stops early (closing the generator), so pages
+            # nobody is going to read are not fetched
+            executor.shutdown(wait=False, cancel_futures=True)
+
     def __iter__(self):
+        if self.prefetch_pages > 0:
+            yield from self._iter_prefetched()
+            return
         while True:
             current_page_results = self.get_next_results_page()
             if not current_page_results:
@@ -33,6 +90,7 @@ class BaseSearch(object):
 
 
 class FoodComSearch(BaseSearch):
+    name = "food_com"
 
     json_extractor = re.compile(r"var searchResults = (.*);\r\nFD.searchParameters")
 
@@ -46,13 +104,12 @@ class FoodComSearch(BaseSearch):
             name = recipe_data["main_username"]
         return SearchResult(recipe_data["main_title"], name, recipe_data["record_url"], i)
 
-    def get_results_page(self, page):
-        params = {"pn": page}
+    def _page_request(self, page):
         quoted_search = urllib.parse.quote_plus(self.search_term)
-        response = requests.get("http://www.food.com/search/" + quoted_search, params=params)
-        if not response.status_code == requests.codes.ok:
-            raise SearchRequestException(response)
-        recipe_json = self.json_extractor.findall(response.text)[0]
+        return "http://www.food.com/search/" + quoted_search, {"pn": page}
+
+    def _parse_results_page(self, response_text, page):
+        recipe_json = self.json_extractor.findall(response_text)[0]
         if not recipe_json:
             # Not sure whether this should return an empty tuple, or raise an exception...  Need to learn more
             # about Food.com search functionality.
@@ -63,6 +120,8 @@ class FoodComSearch(BaseSearch):
 
 
 class FoodNetworkSearch(BaseSearch):
+    name = "food_network"
+
     @staticmethod
     def _format_result(recipe_etree, i):
         """Transforms a Food Network recipe search result element tree into a Metarecipe SearchResult object"""
@@ -78,11 +137,88 @@ class FoodNetworkSearch(BaseSearch):
 
         return SearchResult(title, author, url, i)
 
-    def get_results_page(self, page):
-        params = {"searchTerm": self.search_term, "page": page}
-        response = requests.get("http://www.foodnetwork.com/search/search-results.html", params=params)
-        if not response.status_code == requests.codes.ok:
-            raise SearchRequestException(response)
-        root = html.fromstring(response.text)
+    def _page_request(self, page):
+        return "http://www.foodnetwork.com/search/search-results.html", {"searchTerm": self.search_term, "page": page}
+
+    def _parse_results_page(self, response_text, page):
+        root = html.fromstring(response_text)
         recipes = root.xpath(".//article[@class='recipe']")
         return [self._format_result(recipe, (page - 1) * 10 + i) for (i, recipe) in enumerate(recipes)]
+
+
+# Kept alive between requests.  A provider that misses its deadline is cancelled if it hasn't started, and otherwise
+# finishes once its fetch times out at the deadline
+_federated_executor = ThreadPoolExecutor(max_workers=8)
+
+
+def normalize_url(url):
+    parts = urllib.parse.urlsplit(url.strip())
+    netloc = parts.netloc.lower()
+    if netloc.startswith("www."):
+        netloc = netloc[4:]
+    return urllib.parse.urlunsplit(("http", netloc, parts.path.rstrip("/"), parts.query, ""))
+
+
+def _merge_results(provider_results):
+    # Interleave by rank, so that the top result of each provider comes before any provider's second result
+    merged = sorted(chain.from_iterable(provider_results), key=lambda result: result.result_id)
+    seen_urls = set()
+    results = []
+    for result in merged:
+        url = normalize_url(result.url)
+        if url not in seen_urls:
+            seen_urls.add(url)
+            results.append(result)
+    return results
+
+
+def _search_before(provider_search, page, end):
+    remaining = end - time.monotonic()
+    if remaining <= 0:
+        raise TimeoutError()
+    return provider_search.get_results_page(page, timeout=remaining)
+
+
+def federated_search(search_term, page=1, deadline=5.0):
+    """Searches every provider at once, waiting at most deadline seconds.  Returns the merged results along with the
+    status of each provider, so slow or failing providers only cost their own results."""
+    end = time.monotonic() + deadline
+    # Providers run in a copy of the caller's context, so per-request state such as instrumentation follows them
+    providers = {_federated_executor.submit(contextvars.copy_context().run, _search_before,
+                                            provider(search_term, page), int(page), end): provider.name
+                 for provider in BaseSearch.__subclasses__()}
+    done, not_done = wait(providers, timeout=deadline)
+    for future in not_done:
+        future.cancel()
+    statuses = {}
+    provider_results = []
+    # Walk the providers in registration order so that ties in rank are always broken the same way
+    for future, name in providers.items():
+        if future in not_done:
+            statuses[name] = "timeout"
+        elif future.exception():
+            statuses[name] = "error"
+        else:
+            statuses[name] = "ok"
+            provider_results.append(future.result())
+    return _merge_results(provider_results), statuses
+
+
+async def federated_search_async(search_term, page=1, deadline=5.0, fetcher=None):
+    """federated_search for the ASGI serving mode.  Providers that miss the deadline are cancelled."""
+    providers = {asyncio.ensure_future(provider(search_term, page).get_results_page_async(int(page), fetcher)):
+                 provider.name for provider in BaseSearch.__subclasses__()}
+    done, not_done = await asyncio.wait(providers, timeout=deadline)
+    for future in not_done:
+        future.cancel()
+    statuses = {}
+    provider_results = []
+    for future, name in providers.items():
+        if future in not_done:
+            statuses[name] = "timeout"
+        elif future.exception():
+            statuses[name] = "error"
+        else:
+            statuses[name] = "ok"
+            provider_results.append(future.result())
+    return _merge_results(provider_results), statuses
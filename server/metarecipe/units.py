@@ -0,0 +1,90 @@
+import re
+from collections import namedtuple
+from functools import lru_cache
+from tokenize import TokenError
+from pint import DimensionalityError, UnitRegistry, UndefinedUnitError
+
+ureg = UnitRegistry()
+
+_cubic_meter = ureg.meter ** 3
+_gram = ureg.gram
+
+# Most measure descriptions in the USDA weights file conform to this pattern, e.g. "cup, chopped"
+_measure_re = re.compile(r"([\w\s]+?)(?:\s+\(.*\))?(?:,\s+(.*))?\Z")
+
+# US regulation defines a fluid ounce as equivalent to 30mL for nutrition labeling purposes
+_fluid_ounce_cubic_meters = 30e-6
+
+# Pint fails in many ways on scraped text that isn't a unit expression, e.g. "(" raises TokenError and "$" an
+# AssertionError
+_parse_errors = (DimensionalityError, TokenError, ValueError, TypeError, AttributeError, AssertionError,
+                 ZeroDivisionError)
+
+# description: what is stored as the ingredient preparation's description
+# cubic_meters: the volume of one unit of the measure, or None if the measure has no known volume
+# keep: False for measures with units that aren't volumes (e.g. "oz"), which are left out of the import
+MeasureResolution = namedtuple("MeasureResolution", ["description", "cubic_meters", "keep"])
+
+
+def parse_unit(unit_name):
+    """Parses unit_name with pint, raising UndefinedUnitError for anything it can't make sense of."""
+    try:
+        return ureg.parse_expression(unit_name)
+    except _parse_errors as e:
+        raise UndefinedUnitError(unit_name) from e
+
+
+@lru_cache(maxsize=None)
+def cubic_meters_per_unit(unit_name):
+    """Returns the volume of one unit_name in cubic meters, or None if unit_name isn't a unit of volume.  Raises
+    UndefinedUnitError if pint doesn't know unit_name."""
+    # Pint thinks fl oz is femtolitre ounces
+    if unit_name == "fl oz":
+        return _fluid_ounce_cubic_meters
+    quantity = parse_unit(unit_name)
+    if not hasattr(quantity, "dimensionality") or quantity.dimensionality != _cubic_meter.dimensionality:
+        return None
+    return float(quantity.to_base_units().magnitude)
+
+
+@lru_cache(maxsize=None)
+def resolve_measure(measure_description):
+    """Resolves a USDA weight measure description once; every later row with the same description is a cache hit."""
+    if measure_description == "fl oz":
+        return MeasureResolution("fluid ounces", _fluid_ounce_cubic_meters, True)
+    # Special case, as pat matches a unit, but in this context should not be interpreted as such
+    if measure_description.startswith("pat "):
+        return MeasureResolution(measure_description, None, True)
+    match = _measure_re.match(measure_description)
+    if not match:
+        return MeasureResolution(measure_description, None, True)
+    (unit_name, preparation) = match.groups()
+    # First determine that this weight contains units rather than something nebulous like a "serving"
+    try:
+        cubic_meters = cubic_meters_per_unit(unit_name)
+    except UndefinedUnitError:
+        return MeasureResolution(measure_description, None, True)
+    if cubic_meters is None:
+        return MeasureResolution(preparation, None, False)
+    return MeasureResolution(preparation, cubic_meters, True)
+
+
+@lru_cache(maxsize=None)
+def grams_per_unit(unit_name):
+    """Returns the mass of one unit_name in grams, or None if unit_name isn't a known unit of mass."""
+    try:
+        quantity = parse_unit(unit_name)
+    except UndefinedUnitError:
+        return None
+    if not hasattr(quantity, "dimensionality") or quantity.dimensionality != _gram.dimensionality:
+        return None
+    return float(quantity.to(_gram).magnitude)
+
+
+def to_cubic_meters(quantity, unit_name):
+    """Converts an amount of unit_name to cubic meters, returning None if unit_name isn't a known volume."""
+    try:
+        factor = cubic_meters_per_unit(unit_name)
+    except UndefinedUnitError:
+        return None
+    return None if factor is None else quantity * factor
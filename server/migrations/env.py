@@ -0,0 +1,27 @@
+from logging.config import fileConfig
+from alembic import context
+from metarecipe.app import app, db
+
+if context.config.config_file_name is not None:
+    fileConfig(context.config.config_file_name, disable_existing_loggers=False)
+
+
+def run_migrations_offline():
+    context.configure(url=app.config["SQLALCHEMY_DATABASE_URI"], target_metadata=db.metadata, literal_binds=True,
+                      render_as_batch=True)
+    with context.begin_transaction():
+        context.run_migrations()
+
+
+def run_migrations_online():
+    with app.app_context(), db.engine.connect() as connection:
+        # Batch mode lets the same migrations alter tables on SQLite, which is used for local testing
+        context.configure(connection=connection, target_metadata=db.metadata, render_as_batch=True)
+        with context.begin_transaction():
+            context.run_migrations()
+
+
+if context.is_offline_mode():
+    run_migrations_offline()
+else:
+    run_migrations_online()
@@ -0,0 +1,155 @@
+"""baseline schema
+
+Revision ID: 0001
+Revises:
+Create Date: 2026-10-18 09:11:46.149380
+
+The schema db.metadata.create_all created before the schema was managed by migrations.  Databases created that way
+should be marked as being at this revision with "alembic stamp 0001" and then upgraded, which adds everything the
+models gained since (0001a onwards).
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = '0001'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('ingredient',
+    sa.Column('ingredient_id', sa.Integer(), nullable=False),
+    sa.Column('ingredient_name', sa.Text(), nullable=True),
+    sa.Column('about', sa.Text(), nullable=True),
+    sa.Column('culinary_history', sa.Text(), nullable=True),
+    sa.PrimaryKeyConstraint('ingredient_id')
+    )
+    op.create_table('nutrient',
+    sa.Column('nutrient_id', sa.Integer(), nullable=False),
+    sa.Column('display_name', sa.Unicode(), nullable=True),
+    sa.Column('scientific_name', sa.Unicode(), nullable=True),
+    sa.Column('measurement_unit', sa.Unicode(), nullable=True),
+    sa.Column('recommended_daily_intake', sa.Float(), nullable=True),
+    sa.Column('about', sa.Unicode(), nullable=True),
+    sa.Column('display', sa.Boolean(), nullable=True),
+    sa.PrimaryKeyConstraint('nutrient_id')
+    )
+    op.create_table('recipe',
+    sa.Column('recipe_id', sa.Integer(), nullable=False),
+    sa.Column('preparation_time', sa.Time(), nullable=True),
+    sa.Column('cooking_time', sa.Time(), nullable=True),
+    sa.Column('other_time', sa.Time(), nullable=True),
+    sa.Column('total_time', sa.Time(), nullable=True),
+    sa.Column('title', sa.Unicode(), nullable=True),
+    sa.PrimaryKeyConstraint('recipe_id')
+    )
+    op.create_table('recipe_step_group',
+    sa.Column('recipe_step_group_id', sa.Integer(), nullable=False),
+    sa.Column('title', sa.Text(), nullable=True),
+    sa.PrimaryKeyConstraint('recipe_step_group_id')
+    )
+    op.create_table('ingredient_name',
+    sa.Column('ingredient_name_id', sa.Integer(), nullable=False),
+    sa.Column('ingredient_id', sa.Integer(), nullable=True),
+    sa.Column('name', sa.Unicode(), nullable=True),
+    sa.Column('canonical', sa.Boolean(), nullable=True),
+    sa.Column('creator', sa.Integer(), nullable=True),
+    sa.ForeignKeyConstraint(['ingredient_id'], ['ingredient.ingredient_id'], ),
+    sa.PrimaryKeyConstraint('ingredient_name_id')
+    )
+    op.create_table('ingredient_nutrient',
+    sa.Column('ingredient_nutrient_id', sa.Integer(), nullable=False),
+    sa.Column('nutrient_id', sa.Integer(), nullable=True),
+    sa.Column('ingredient_id', sa.Integer(), nullable=True),
+    sa.Column('quantity', sa.Float(), nullable=True),
+    sa.ForeignKeyConstraint(['ingredient_id'], ['ingredient.ingredient_id'], ),
+    sa.ForeignKeyConstraint(['nutrient_id'], ['nutrient.nutrient_id'], ),
+    sa.PrimaryKeyConstraint('ingredient_nutrient_id')
+    )
+    op.create_table('ingredient_preparation',
+    sa.Column('ingredient_preparation_id', sa.Integer(), nullable=False),
+    sa.Column('ingredient_id', sa.Integer(), nullable=True),
+    sa.Column('description', sa.Unicode(), nullable=True),
+    sa.Column('amount', sa.Float(), nullable=True),
+    sa.Column('weight', sa.Float(), nullable=True),
+    sa.Column('density', sa.Float(), nullable=True),
+    sa.ForeignKeyConstraint(['ingredient_id'], ['ingredient.ingredient_id'], ),
+    sa.PrimaryKeyConstraint('ingredient_preparation_id')
+    )
+    op.create_table('recipe_document',
+    sa.Column('recipe_document_id', sa.Integer(), nullable=False),
+    sa.Column('title', sa.Text(), nullable=True),
+    sa.Column('html', sa.Unicode(), nullable=True),
+    sa.Column('url', sa.Text(), nullable=True),
+    sa.Column('retrieval_timestamp', sa.DateTime(), nullable=True),
+    sa.Column('recipe_id', sa.Integer(), nullable=True),
+    sa.ForeignKeyConstraint(['recipe_id'], ['recipe.recipe_id'], ),
+    sa.PrimaryKeyConstraint('recipe_document_id'),
+    sa.UniqueConstraint('url')
+    )
+    op.create_table('recipe_ingredient',
+    sa.Column('recipe_ingredient_id', sa.Integer(), nullable=False),
+    sa.Column('component', sa.Text(), nullable=True),
+    sa.Column('quantity', sa.Float(), nullable=True),
+    sa.Column('units', sa.Text(), nullable=True),
+    sa.Column('ingredient_id', sa.Integer(), nullable=True),
+    sa.Column('ingredient_form', sa.Text(), nullable=True),
+    sa.Column('recipe_id', sa.Integer(), nullable=True),
+    sa.ForeignKeyConstraint(['ingredient_id'], ['ingredient.ingredient_id'], ),
+    sa.ForeignKeyConstraint(['recipe_id'], ['recipe.recipe_id'], ),
+    sa.PrimaryKeyConstraint('recipe_ingredient_id')
+    )
+    op.create_table('recipe_step',
+    sa.Column('recipe_step_id', sa.Integer(), nullable=False),
+    sa.Column('text', sa.Text(), nullable=True),
+    sa.Column('recipe_step_group_id', sa.Integer(), nullable=True),
+    sa.Column('recipe_id', sa.Integer(), nullable=True),
+    sa.ForeignKeyConstraint(['recipe_id'], ['recipe.recipe_id'], ),
+    sa.ForeignKeyConstraint(['recipe_step_group_id'], ['recipe_step_group.recipe_step_group_id'], ),
+    sa.PrimaryKeyConstraint('recipe_step_id')
+    )
+    op.create_table('recipe_document_tag_set',
+    sa.Column('recipe_document_tagset_id', sa.Integer(), nullable=False),
+    sa.Column('recipe_document_id', sa.Integer(), nullable=True),
+    sa.ForeignKeyConstraint(['recipe_document_id'], ['recipe_document.recipe_document_id'], ),
+    sa.PrimaryKeyConstraint('recipe_document_tagset_id')
+    )
+    op.create_table('recipe_document_word',
+    sa.Column('recipe_document_word_id', sa.Integer(), nullable=False),
+    sa.Column('word', sa.Unicode(), nullable=True),
+    sa.Column('document_position', sa.Integer(), nullable=True),
+    sa.Column('element_position', sa.Integer(), nullable=True),
+    sa.Column('element_tag', sa.Text(), nullable=True),
+    sa.Column('original_format', sa.Text(), nullable=True),
+    sa.Column('recipe_document_id', sa.Integer(), nullable=True),
+    sa.ForeignKeyConstraint(['recipe_document_id'], ['recipe_document.recipe_document_id'], ),
+    sa.PrimaryKeyConstraint('recipe_document_word_id')
+    )
+    op.create_table('recipe_document_word_tag',
+    sa.Column('recipe_document_word_tag_id', sa.Integer(), nullable=False),
+    sa.Column('tag', sa.Unicode(), nullable=True),
+    sa.Column('recipe_document_word_id', sa.Integer(), nullable=True),
+    sa.Column('recipe_document_id', sa.Integer(), nullable=True),
+    sa.ForeignKeyConstraint(['recipe_document_id'], ['recipe_document.recipe_document_id'], ),
+    sa.ForeignKeyConstraint(['recipe_document_word_id'],
+                            ['recipe_document_word.recipe_document_word_id'], ),
+    sa.PrimaryKeyConstraint('recipe_document_word_tag_id')
+    )
+
+
+def downgrade():
+    op.drop_table('recipe_document_word_tag')
+    op.drop_table('recipe_document_word')
+    op.drop_table('recipe_document_tag_set')
+    op.drop_table('recipe_step')
+    op.drop_table('recipe_ingredient')
+    op.drop_table('recipe_document')
+    op.drop_table('ingredient_preparation')
+    op.drop_table('ingredient_nutrient')
+    op.drop_table('ingredient_name')
+    op.drop_table('recipe_step_group')
+    op.drop_table('recipe')
+    op.drop_table('nutrient')
+    op.drop_table('ingredient')
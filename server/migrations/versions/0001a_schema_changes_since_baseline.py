@@ -0,0 +1,65 @@
+"""schema changes since the baseline
+
+Revision ID: 0001a
+Revises: 0001
+Create Date: 2026-10-18 18:05:41.330718
+
+What the models gained between the last create_all schema and the first migration: the ingredient name trigram
+index, USDA measure sequence numbers, the unique keys the USDA importer upserts on, tag sets per tag and stored
+recipe nutrition.  Duplicate rows already in a database will make adding the unique constraints fail, and have to be
+removed by hand first.  Measures imported before this revision get their sequence numbers on the next incremental
+USDA import.
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = '0001a'
+down_revision = '0001'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    if op.get_bind().dialect.name == "postgresql":
+        op.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+    op.create_index('ix_ingredient_name_name_trgm', 'ingredient_name', ['name'], unique=False,
+                    postgresql_using='gist', postgresql_ops={'name': 'gist_trgm_ops'})
+    # Named as PostgreSQL would name them, so they can be dropped again
+    with op.batch_alter_table('ingredient_nutrient') as batch_op:
+        batch_op.create_unique_constraint('ingredient_nutrient_ingredient_id_nutrient_id_key',
+                                          ['ingredient_id', 'nutrient_id'])
+    with op.batch_alter_table('ingredient_preparation') as batch_op:
+        batch_op.add_column(sa.Column('sequence', sa.Integer(), nullable=True))
+        batch_op.create_unique_constraint('ingredient_preparation_ingredient_id_sequence_key',
+                                          ['ingredient_id', 'sequence'])
+    with op.batch_alter_table('recipe_document_tag_set') as batch_op:
+        batch_op.create_unique_constraint('recipe_document_tag_set_recipe_document_id_key', ['recipe_document_id'])
+    with op.batch_alter_table('recipe_document_word_tag') as batch_op:
+        batch_op.add_column(sa.Column('recipe_document_tagset_id', sa.Integer(), nullable=True))
+        batch_op.create_foreign_key('recipe_document_word_tag_recipe_document_tagset_id_fkey',
+                                    'recipe_document_tag_set', ['recipe_document_tagset_id'],
+                                    ['recipe_document_tagset_id'])
+    op.create_table('recipe_nutrition',
+    sa.Column('recipe_id', sa.Integer(), nullable=False),
+    sa.Column('nutrients', sa.JSON(), nullable=True),
+    sa.Column('unresolved_ingredients', sa.JSON(), nullable=True),
+    sa.Column('computed_timestamp', sa.DateTime(), nullable=True),
+    sa.ForeignKeyConstraint(['recipe_id'], ['recipe.recipe_id'], ),
+    sa.PrimaryKeyConstraint('recipe_id')
+    )
+
+
+def downgrade():
+    op.drop_table('recipe_nutrition')
+    with op.batch_alter_table('recipe_document_word_tag') as batch_op:
+        batch_op.drop_constraint('recipe_document_word_tag_recipe_document_tagset_id_fkey', type_='foreignkey')
+        batch_op.drop_column('recipe_document_tagset_id')
+    with op.batch_alter_table('recipe_document_tag_set') as batch_op:
+        batch_op.drop_constraint('recipe_document_tag_set_recipe_document_id_key', type_='unique')
+    with op.batch_alter_table('ingredient_preparation') as batch_op:
+        batch_op.drop_constraint('ingredient_preparation_ingredient_id_sequence_key', type_='unique')
+        batch_op.drop_column('sequence')
+    with op.batch_alter_table('ingredient_nutrient') as batch_op:
+        batch_op.drop_constraint('ingredient_nutrient_ingredient_id_nutrient_id_key', type_='unique')
+    op.drop_index('ix_ingredient_name_name_trgm', table_name='ingredient_name')
@@ -0,0 +1,40 @@
+"""query indexes
+
+Revision ID: 0002
+Revises: 0001a
+Create Date: 2026-10-18 09:12:03.551946
+
+Indexes for the filters and joins in endpoints.py, which were all sequential scans.  The tag set's
+recipe_document_id is already covered by its unique constraint, and ingredient_nutrient lookups by ingredient_id
+by the (ingredient_id, nutrient_id) one.
+"""
+from alembic import op
+
+
+revision = '0002'
+down_revision = '0001a'
+branch_labels = None
+depends_on = None
+
+indexes = [
+    ('ix_recipe_document_word_document_position', 'recipe_document_word', ['recipe_document_id', 'document_position']),
+    ('ix_recipe_document_word_tag_tagset_word', 'recipe_document_word_tag',
+     ['recipe_document_tagset_id', 'recipe_document_word_id']),
+    ('ix_recipe_document_word_tag_word', 'recipe_document_word_tag', ['recipe_document_word_id']),
+    ('ix_recipe_document_word_tag_document_tag', 'recipe_document_word_tag', ['recipe_document_id', 'tag']),
+    ('ix_ingredient_nutrient_nutrient', 'ingredient_nutrient', ['nutrient_id', 'ingredient_id']),
+    ('ix_recipe_ingredient_recipe', 'recipe_ingredient', ['recipe_id']),
+]
+
+
+def upgrade():
+    # recipe_document_word can be very large, so PostgreSQL builds the indexes without locking out writes, which
+    # can't be done inside a transaction
+    with op.get_context().autocommit_block():
+        for (name, table, columns) in indexes:
+            op.create_index(name, table, columns, unique=False, postgresql_concurrently=True)
+
+
+def downgrade():
+    for (name, table, columns) in reversed(indexes):
+        op.drop_index(name, table_name=table)
@@ -0,0 +1,42 @@
+"""retrieval jobs
+
+Revision ID: 0003
+Revises: 0002
+Create Date: 2026-10-18 14:02:37.208114
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = '0003'
+down_revision = '0002'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('retrieval_job',
+    sa.Column('retrieval_job_id', sa.Integer(), nullable=False),
+    sa.Column('created_timestamp', sa.DateTime(), nullable=True),
+    sa.Column('started_timestamp', sa.DateTime(), nullable=True),
+    sa.Column('finished_timestamp', sa.DateTime(), nullable=True),
+    sa.PrimaryKeyConstraint('retrieval_job_id')
+    )
+    op.create_table('retrieval_job_url',
+    sa.Column('retrieval_job_id', sa.Integer(), nullable=False),
+    sa.Column('position', sa.Integer(), nullable=False),
+    sa.Column('url', sa.Text(), nullable=True),
+    sa.Column('state', sa.Text(), nullable=True),
+    sa.Column('attempts', sa.Integer(), nullable=True),
+    sa.Column('error', sa.Text(), nullable=True),
+    sa.Column('recipe_document_id', sa.Integer(), nullable=True),
+    sa.ForeignKeyConstraint(['recipe_document_id'], ['recipe_document.recipe_document_id'], ),
+    sa.ForeignKeyConstraint(['retrieval_job_id'], ['retrieval_job.retrieval_job_id'], ),
+    sa.PrimaryKeyConstraint('retrieval_job_id', 'position')
+    )
+
+
+def downgrade():
+    op.drop_table('retrieval_job_url')
+    op.drop_table('retrieval_job')
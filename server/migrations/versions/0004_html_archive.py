@@ -0,0 +1,120 @@
+"""html archive
+
+Revision ID: 0004
+Revises: 0003
+Create Date: 2026-10-18 16:40:12.873520
+
+Moves recipe_document.html into the archived_page table read by metarecipe.archive.DatabaseArchive, gzipped and
+keyed by its SHA-256, leaving only its key in the row.  The raw pages of existing documents were never kept, so their
+raw_html_sha256 stays empty.  Apps that set HTML_ARCHIVE_PATH to keep pages on disk read the migrated pages from
+archived_page when they aren't on disk.
+"""
+import gzip
+import hashlib
+import io
+
+from alembic import op
+import sqlalchemy as sa
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+revision = '0004'
+down_revision = '0003'
+branch_labels = None
+depends_on = None
+
+recipe_document = sa.table('recipe_document',
+                           sa.column('recipe_document_id', sa.Integer),
+                           sa.column('html', sa.Unicode),
+                           sa.column('html_sha256', sa.String(64)))
+archived_page = sa.table('archived_page',
+                         sa.column('sha256', sa.String(64)),
+                         sa.column('codec', sa.Text),
+                         sa.column('size', sa.Integer),
+                         sa.column('content', sa.LargeBinary))
+batch_size = 500
+
+
+def _batches(connection, column):
+    after = 0
+    while True:
+        rows = connection.execute(sa.select([recipe_document.c.recipe_document_id, column])
+                                  .where(recipe_document.c.recipe_document_id > after)
+                                  .where(column.isnot(None))
+                                  .order_by(recipe_document.c.recipe_document_id)
+                                  .limit(batch_size)).fetchall()
+        if not rows:
+            return
+        yield rows
+        after = rows[-1][0]
+
+
+def _store_pages(connection, pages):
+    present = set(row[0] for row in connection.execute(sa.select([archived_page.c.sha256])
+                                                       .where(archived_page.c.sha256.in_(list(pages)))).fetchall())
+    rows = [{"sha256": key, "codec": "gzip", "size": len(data), "content": gzip.compress(data, compresslevel=6)}
+            for (key, data) in pages.items() if key not in present]
+    if rows:
+        connection.execute(archived_page.insert(), rows)
+
+
+def _read_pages(connection, keys):
+    pages = {}
+    for (key, codec, content) in connection.execute(sa.select([archived_page.c.sha256, archived_page.c.codec,
+                                                               archived_page.c.content])
+                                                    .where(archived_page.c.sha256.in_(list(set(keys))))).fetchall():
+        if codec == "zstd":
+            with zstandard.ZstdDecompressor().stream_reader(io.BytesIO(content)) as f:
+                pages[key] = f.read()
+        else:
+            pages[key] = gzip.decompress(content)
+    return pages
+
+
+def upgrade():
+    op.create_table('archived_page',
+    sa.Column('sha256', sa.String(length=64), nullable=False),
+    sa.Column('codec', sa.Text(), nullable=True),
+    sa.Column('size', sa.Integer(), nullable=True),
+    sa.Column('content', sa.LargeBinary(), nullable=True),
+    sa.PrimaryKeyConstraint('sha256')
+    )
+    with op.batch_alter_table('recipe_document') as batch_op:
+        batch_op.add_column(sa.Column('raw_html_sha256', sa.String(length=64), nullable=True))
+        batch_op.add_column(sa.Column('html_sha256', sa.String(length=64), nullable=True))
+    connection = op.get_bind()
+    for rows in _batches(connection, recipe_document.c.html):
+        pages = {}
+        for (document_id, html) in rows:
+            data = html.encode("utf-8")
+            key = hashlib.sha256(data).hexdigest()
+            pages[key] = data
+            connection.execute(recipe_document.update()
+                               .where(recipe_document.c.recipe_document_id == document_id)
+                               .values(html_sha256=key))
+        _store_pages(connection, pages)
+    with op.batch_alter_table('recipe_document') as batch_op:
+        batch_op.drop_column('html')
+
+
+def downgrade():
+    with op.batch_alter_table('recipe_document') as batch_op:
+        batch_op.add_column(sa.Column('html', sa.Unicode(), nullable=True))
+    connection = op.get_bind()
+    for rows in _batches(connection, recipe_document.c.html_sha256):
+        pages = _read_pages(connection, [key for (document_id, key) in rows])
+        for (document_id, key) in rows:
+            # A page missing from the archive leaves its document without html rather than stopping the downgrade
+            if key not in pages:
+                continue
+            connection.execute(recipe_document.update()
+                               .where(recipe_document.c.recipe_document_id == document_id)
+                               .values(html=pages[key].decode("utf-8")))
+    with op.batch_alter_table('recipe_document') as batch_op:
+        batch_op.drop_column('html_sha256')
+        batch_op.drop_column('raw_html_sha256')
+    op.drop_table('archived_page')
@@ -0,0 +1,4 @@
+import uvicorn
+from metarecipe.asgi import application
+
+uvicorn.run(application, port=8000)
@@ -1,9 +1,8 @@
-import metarecipe.models as m
-from metarecipe.app import app, db
+from alembic import command
+from alembic.config import Config
 
 if __name__ == "__main__":
-    with app.test_request_context():
-        db.metadata.drop_all()
-        db.metadata.create_all()
-        # m.Ingredient.query.order_by(db.desc(db.func.similarity("chicken", m.Ingredient.ingredient_name))).limit(10).all()
-
+    # Rebuilds the schema from scratch by running every migration down and back up
+    migrations = Config("alembic.ini")
+    command.downgrade(migrations, "base")
+    command.upgrade(migrations, "head")